@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the line-oriented HLS parser of the speed test against m3u8.loads.
+
+Usage, from the project root:
+    python -m benchmarks.hls_parser [playlist file or url ...] [--number 2000] [--limit 5]
+
+Without arguments, a set of built-in playlists shaped like the ones served by IPTV sources is used.
+"""
+import argparse
+import timeit
+
+import m3u8
+import requests
+
+from utils.speed import parse_hls_playlist, sample_segment_urls
+
+MASTER_PLAYLIST = "#EXTM3U\n#EXT-X-VERSION:3\n" + "".join(
+    f'#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH={bandwidth},AVERAGE-BANDWIDTH={bandwidth - 1000},'
+    f'RESOLUTION={resolution},CODECS="avc1.64001f,mp4a.40.2"\n{resolution}/index.m3u8?token=abcdef\n'
+    for bandwidth, resolution in [(800000, "640x360"), (1400000, "854x480"), (2800000, "1280x720"),
+                                  (5000000, "1920x1080"), (16000000, "3840x2160")]
+)
+
+
+def get_media_playlist(segment_count, sequence=1700000000):
+    header = f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:{sequence}\n"
+    segments = "".join(
+        f"#EXT-X-PROGRAM-DATE-TIME:2025-01-01T00:{i // 10 % 60:02d}:{i * 6 % 60:02d}.000+08:00\n"
+        f"#EXTINF:6.000,\n/live/channel/{sequence + i}.ts?txSecret=0123456789abcdef&txTime=65f0a000\n"
+        for i in range(segment_count)
+    )
+    return header + segments
+
+
+BUILTIN_PLAYLISTS = {
+    "master (5 variants)": MASTER_PLAYLIST,
+    "live media (6 segments)": get_media_playlist(6),
+    "live media (30 segments)": get_media_playlist(30),
+    "vod media (1800 segments)": get_media_playlist(1800),
+}
+
+
+def load_playlists(sources):
+    playlists = {}
+    for source in sources:
+        if source.startswith(("http://", "https://")):
+            playlists[source] = requests.get(source, timeout=10).text
+        else:
+            with open(source, "r", encoding="utf-8") as f:
+                playlists[source] = f.read()
+    return playlists
+
+
+def parse_with_m3u8(content, limit):
+    obj = m3u8.loads(content)
+    variants = [(p.stream_info.bandwidth, p.uri) for p in obj.playlists]
+    segments = sample_segment_urls([segment.uri for segment in obj.segments], limit)
+    return variants, segments
+
+
+def parse_with_lines(content, limit):
+    playlist = parse_hls_playlist(content, limit)
+    if playlist is None:
+        return None
+    variants = [(variant["bandwidth"], variant["uri"]) for variant in playlist["variants"]]
+    segments = [segment["uri"] for segment in playlist["segments"]]
+    return variants, segments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="*", help="playlist files or urls")
+    parser.add_argument("--number", type=int, default=2000, help="parses per measurement")
+    parser.add_argument("--limit", type=int, default=5, help="number of sampled segments")
+    args = parser.parse_args()
+
+    playlists = load_playlists(args.sources) if args.sources else BUILTIN_PLAYLISTS
+    print(f"{'playlist':<40} {'m3u8.loads':>12} {'line parser':>12} {'speedup':>8}  same result")
+    for name, content in playlists.items():
+        line_result = parse_with_lines(content, args.limit)
+        if line_result is None:
+            print(f"{name[:40]:<40} {'':>12} {'fallback':>12}")
+            continue
+        same = line_result == parse_with_m3u8(content, args.limit)
+        m3u8_time = min(timeit.repeat(lambda: parse_with_m3u8(content, args.limit), number=args.number, repeat=3))
+        line_time = min(timeit.repeat(lambda: parse_with_lines(content, args.limit), number=args.number, repeat=3))
+        print(
+            f"{name[:40]:<40} {m3u8_time / args.number * 1e6:>10.1f}us {line_time / args.number * 1e6:>10.1f}us "
+            f"{m3u8_time / line_time:>7.1f}x  {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of the location/ISP lookups done while appending the channel data: one database lookup per url
+against the IP-keyed LRU cache filled by the batch pre-pass.
+
+Usage, from the project root:
+    python -m benchmarks.ip_lookup [--urls 100000] [--ips 5000] [--seed 0]
+
+The urls use IP literal hosts, so the measurement is not affected by DNS resolution.
+"""
+import argparse
+import random
+import time
+
+from utils.ip_checker import IPChecker
+
+
+def get_urls(url_count, ip_count, seed):
+    rng = random.Random(seed)
+    ips = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}" for _ in
+           range(ip_count)]
+    return [f"http://{rng.choice(ips)}:{rng.choice((80, 8080, 9901))}/live/{i}.m3u8" for i in range(url_count)]
+
+
+def run_per_url_lookup(checker, urls):
+    return [checker.lookup_map(ip) for url in urls if (ip := checker.get_ip(url))]
+
+
+def run_cached_lookup(checker, urls):
+    checker.prefetch_maps(urls)
+    return [checker.find_map(ip) for url in urls if (ip := checker.get_ip(url))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--urls", type=int, default=100000, help="number of urls")
+    parser.add_argument("--ips", type=int, default=5000, help="number of unique IPs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    urls = get_urls(args.urls, args.ips, args.seed)
+    checker = IPChecker()
+    for url in urls:
+        checker.get_ip(url)
+
+    start = time.perf_counter()
+    per_url = run_per_url_lookup(checker, urls)
+    per_url_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cached = run_cached_lookup(checker, urls)
+    cached_time = time.perf_counter() - start
+
+    print(f"urls: {len(urls)}, unique IPs: {len(checker.ip_map)}")
+    print(f"per url lookup: {per_url_time:.3f}s")
+    print(f"pre-pass + LRU: {cached_time:.3f}s ({per_url_time / cached_time:.1f}x), same result: {per_url == cached}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Generate the benchmark input: the in-memory channel data handed to test_speed.
+"""
+import random
+
+KINDS = ("ok", "redirect", "missing", "slow", "stall")
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        if "=" in item:
+            kind, _, weight = item.partition("=")
+            kind = kind.strip()
+            if kind not in KINDS:
+                raise ValueError(f"Unknown endpoint kind: {kind}")
+            weights[kind] = float(weight)
+    return weights
+
+
+def get_url(kind, stream_id, port):
+    if kind == "redirect":
+        return f"http://127.0.0.1:{port}/redirect/{stream_id}"
+    return f"http://127.0.0.1:{port}/{kind}/{stream_id}/master.m3u8"
+
+
+def generate_channel_data(channels: int, urls: int, ports: list[int], mix: dict[str, float], seed: int = 0):
+    """
+    Generate the data of test_speed: one category with channels × urls entries spread over the ports
+    """
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    data = {"Benchmark": {}}
+    for channel in range(channels):
+        name = f"Channel-{channel}"
+        info_list = []
+        for index in range(urls):
+            stream_id = f"{channel}-{index}"
+            port = ports[(channel * urls + index) % len(ports)]
+            url = get_url(rng.choices(kinds, weights)[0], stream_id, port)
+            info_list.append({
+                "id": stream_id,
+                "url": url,
+                "host": f"http://127.0.0.1:{port}",
+                "origin": "subscribe",
+                "ipv_type": "ipv4",
+                "resolution": None,
+                "headers": None,
+            })
+        data["Benchmark"][name] = info_list
+    return data
+
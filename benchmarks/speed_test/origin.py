@@ -0,0 +1,133 @@
+"""
+Local synthetic HLS/HTTP origin for the speed test benchmark.
+
+Paths, by kind of endpoint:
+    /ok/{id}/master.m3u8, /ok/{id}/media.m3u8, /ok/{id}/seg{n}.ts    healthy stream
+    /slow/{id}/...                                                  healthy stream with extra latency
+    /stall/{id}/...                                                 segments stall after the first chunk
+    /missing/{id}/master.m3u8                                       404
+    /redirect/{id}                                                  302 to /ok/{id}/master.m3u8
+"""
+import asyncio
+from dataclasses import dataclass
+
+from aiohttp import web
+
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class OriginConfig:
+    latency: float = 0.02
+    slow_latency: float = 1.0
+    bandwidth: float = 50.0
+    segment_size: int = 1024 * 1024
+    segment_count: int = 6
+    segment_duration: float = 4.0
+
+
+def get_master_playlist(kind, stream_id):
+    return (
+        "#EXTM3U\n#EXT-X-VERSION:3\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=1400000,RESOLUTION=1280x720\n"
+        f"/{kind}/{stream_id}/media.m3u8?variant=720\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1920x1080\n"
+        f"/{kind}/{stream_id}/media.m3u8?variant=1080\n"
+    )
+
+
+def get_media_playlist(config: OriginConfig):
+    return (
+            f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{int(config.segment_duration)}\n"
+            "#EXT-X-MEDIA-SEQUENCE:1\n"
+            + "".join(f"#EXTINF:{config.segment_duration:.3f},\nseg{i}.ts\n" for i in range(config.segment_count))
+    )
+
+
+def create_app(config: OriginConfig) -> web.Application:
+    media_playlist = get_media_playlist(config)
+    segment = b"\x47" * config.segment_size
+
+    async def delay(kind):
+        await asyncio.sleep(config.latency + (config.slow_latency if kind == "slow" else 0))
+
+    async def master(request):
+        kind = request.match_info["kind"]
+        await delay(kind)
+        if kind == "missing":
+            raise web.HTTPNotFound()
+        return web.Response(text=get_master_playlist(kind, request.match_info["id"]),
+                            content_type="application/vnd.apple.mpegurl")
+
+    async def media(request):
+        await delay(request.match_info["kind"])
+        return web.Response(text=media_playlist, content_type="application/vnd.apple.mpegurl")
+
+    async def seg(request):
+        kind = request.match_info["kind"]
+        await delay(kind)
+        start, end = 0, len(segment) - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), end) if last else end
+            status = 206
+        response = web.StreamResponse(status=status, headers={"Content-Type": "video/mp2t"})
+        response.content_length = end - start + 1
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        position = start
+        try:
+            while position <= end:
+                chunk = segment[position:min(position + CHUNK_SIZE, end + 1)]
+                await response.write(chunk)
+                position += len(chunk)
+                if kind == "stall":
+                    while request.transport and not request.transport.is_closing():
+                        await asyncio.sleep(0.5)
+                    break
+                if config.bandwidth > 0:
+                    await asyncio.sleep(len(chunk) / (config.bandwidth * 1024 * 1024))
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def redirect(request):
+        await delay("ok")
+        raise web.HTTPFound(f"/ok/{request.match_info['id']}/master.m3u8")
+
+    app = web.Application()
+    app.router.add_route("*", "/{kind}/{id}/master.m3u8", master)
+    app.router.add_route("*", "/{kind}/{id}/media.m3u8", media)
+    app.router.add_route("*", "/{kind}/{id}/seg{n}.ts", seg)
+    app.router.add_route("*", "/redirect/{id}", redirect)
+    return app
+
+
+async def start_origin(config: OriginConfig, ports: list[int], host: str = "127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(create_app(config), access_log=None)
+    await runner.setup()
+    for port in ports:
+        await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def serve_origin(config: OriginConfig, ports: list[int], ready=None, stop=None) -> None:
+    """
+    Run the origin until the stop event is set, as the target of a separate process
+    """
+
+    async def run():
+        runner = await start_origin(config, ports)
+        if ready:
+            ready.set()
+        try:
+            while not (stop and stop.is_set()):
+                await asyncio.sleep(0.2)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
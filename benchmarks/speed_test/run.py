@@ -0,0 +1,211 @@
+"""
+Hermetic benchmark of the speed test against a local synthetic HLS/HTTP origin: no external network is used,
+so the numbers only move when the speed test code does.
+
+Usage, from the project root:
+    python -m benchmarks.speed_test.run [--channels 100] [--urls 10] [--ports 4]
+        [--mix ok=0.7,redirect=0.1,missing=0.1,slow=0.05,stall=0.05]
+        [--latency 0.02] [--bandwidth 50] [--output result.json] [--baseline result.json --tolerance 0.2]
+
+The origin runs in a separate process listening on several local ports, each port acting as one host.
+
+What is measured: only utils.channel.test_speed, called with channel data generated in memory. The source
+files, get_channel_items and the append stages (append_total_data and the IP lookups) are not run. Two stages
+are reported, "generate" (building the channel data) and "speed test", each with its wall time, its CPU time
+and the peak RSS of this process only. The CPU and memory of the origin process and of any child process of
+the speed test are not included, so speed_test_process_num is 1 unless overridden in the environment, which
+keeps the speed test in this process. The speed test stage also reports the tested urls per second and the p50/p99 probe latency.
+With --baseline, the run fails when the throughput drops or the p99 latency grows by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks.speed_test.inputs import generate_channel_data, parse_mix
+from benchmarks.speed_test.origin import OriginConfig, serve_origin
+
+BENCHMARK_SETTINGS = {
+    "open_filter_resolution": "False",
+    "open_filter_speed": "False",
+    "open_full_speed_test": "True",
+    "open_speed_test_priority": "False",
+    "speed_test_filter_host": "False",
+    "speed_test_cache_ttl": "0",
+    "speed_test_process_num": "1",
+}
+
+
+class Stage:
+    """
+    Measure the wall time, CPU time and peak RSS of a stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.result = {}
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.result = {
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+
+
+def get_peak_rss_mb():
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+async def run_speed_test(data):
+    """
+    Run the speed test of the channel data, timing every probe
+    """
+    import utils.channel as channel
+
+    latencies = []
+    get_speed = channel.get_speed
+
+    async def timed_get_speed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await get_speed(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    channel.get_speed = timed_get_speed
+    try:
+        result = await channel.test_speed(data)
+    finally:
+        channel.get_speed = get_speed
+    return result, latencies
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    failures = []
+    if report["urls_per_second"] < baseline["urls_per_second"] * (1 - tolerance):
+        failures.append(f"urls/s {report['urls_per_second']:.2f} < baseline {baseline['urls_per_second']:.2f}")
+    if baseline.get("p99") and report["p99"] and report["p99"] > baseline["p99"] * (1 + tolerance):
+        failures.append(f"p99 {report['p99']:.3f}s > baseline {baseline['p99']:.3f}s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=100, help="number of channels")
+    parser.add_argument("--urls", type=int, default=10, help="number of urls per channel")
+    parser.add_argument("--ports", type=int, default=4, help="number of local ports (hosts) of the origin")
+    parser.add_argument("--base-port", type=int, default=18500)
+    parser.add_argument("--mix", default="ok=0.7,redirect=0.1,missing=0.1,slow=0.05,stall=0.05",
+                        help="weights of the endpoint kinds")
+    parser.add_argument("--latency", type=float, default=0.02, help="response latency of the origin, seconds")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="extra latency of the slow endpoints")
+    parser.add_argument("--bandwidth", type=float, default=50, help="bandwidth per connection, MB/s, 0 unlimited")
+    parser.add_argument("--segment-size", type=int, default=1024 * 1024, help="size of a segment, bytes")
+    parser.add_argument("--timeout", type=int, default=5, help="speed test timeout, seconds")
+    parser.add_argument("--concurrency", type=int, help="speed test concurrency, the configured one by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this json file")
+    parser.add_argument("--baseline", help="compare the report with this json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    args = parser.parse_args()
+
+    for key, value in BENCHMARK_SETTINGS.items():
+        os.environ.setdefault(key, value)
+    os.environ["speed_test_timeout"] = str(args.timeout)
+    if args.concurrency:
+        os.environ["speed_test_limit"] = str(args.concurrency)
+
+    from utils.i18n import get_language
+    import utils.channel  # noqa: F401, loads the resources relative to the project root before leaving it
+    get_language()
+
+    ports = [args.base_port + i for i in range(args.ports)]
+    origin_config = OriginConfig(latency=args.latency, slow_latency=args.slow_latency, bandwidth=args.bandwidth,
+                                 segment_size=args.segment_size)
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    origin = context.Process(target=serve_origin, args=(origin_config, ports, ready, stop), daemon=True)
+    origin.start()
+    if not ready.wait(timeout=30):
+        origin.terminate()
+        sys.exit("The origin failed to start")
+
+    stages = []
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(prefix="speed_test_benchmark_") as work_dir:
+            os.chdir(work_dir)
+            with Stage("generate") as stage:
+                data = generate_channel_data(args.channels, args.urls, ports, parse_mix(args.mix), args.seed)
+            stages.append(stage)
+
+            with Stage("speed test") as stage:
+                result, latencies = asyncio.run(run_speed_test(data))
+            stages.append(stage)
+    finally:
+        os.chdir(cwd)
+        stop.set()
+        origin.join(timeout=5)
+        if origin.is_alive():
+            origin.terminate()
+
+    total = args.channels * args.urls
+    speed_stage = stages[-1].result
+    report = {
+        "urls": total,
+        "tested": len(latencies),
+        "urls_per_second": total / speed_stage["wall"] if speed_stage["wall"] else 0,
+        "p50": get_percentile(latencies, 50),
+        "p99": get_percentile(latencies, 99),
+        "stages": {stage.name: stage.result for stage in stages},
+    }
+
+    print(f"{'stage':<12} {'wall (s)':>10} {'cpu (s)':>10} {'peak rss (MB)':>14}")
+    for stage in stages:
+        peak_rss = stage.result["peak_rss_mb"]
+        print(f"{stage.name:<12} {stage.result['wall']:>10.2f} {stage.result['cpu']:>10.2f} "
+              f"{'-' if peak_rss is None else f'{peak_rss:.1f}':>14}")
+    print(f"urls: {total}, tested: {report['tested']}, urls/s: {report['urls_per_second']:.2f}")
+    if latencies:
+        print(f"probe latency p50: {report['p50']:.3f}s, p99: {report['p99']:.3f}s")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            failures = compare_with_baseline(report, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f"regression: {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,7 @@
 import asyncio
 import copy
 import datetime
-import gzip
 import os
-import pickle
 import sys
 from time import time
 from typing import Callable, Optional, Any
@@ -13,14 +11,24 @@ from tqdm import tqdm
 
 import utils.constants as constants
 import utils.frozen as frozen
+import utils.history as history
+import utils.speed_store as speed_store
 from updates.epg import get_epg
 from updates.epg.tools import write_to_xml, compress_to_gz
 from updates.subscribe import get_channels_by_subscribe_urls
 from utils.aggregator import ResultAggregator
-from utils.channel import get_channel_items, append_total_data, test_speed
+from utils.channel import (
+    get_channel_items,
+    append_total_data,
+    test_speed,
+    prefetch_total_data_hosts,
+    format_channel_name,
+    ip_checker
+)
 from utils.config import config
 from utils.i18n import t
-from utils.speed import clear_cache
+from utils.speed import clear_cache, stats as speed_stats, store_samples
+from utils.speed_shard import test_speed_sharded
 from utils.tools import (
     get_pbar_remaining,
     process_nested_dict,
@@ -31,7 +39,6 @@ from utils.tools import (
     get_urls_len,
     get_public_url,
     parse_times,
-    to_serializable,
     get_subscribe_entries,
     count_disabled_urls,
 )
@@ -72,10 +79,12 @@ class UpdateSource:
     # ----------------------------
     # progress / pbar
     # ----------------------------
-    def pbar_update(self, name: str = "", item_name: str = ""):
+    def pbar_update(self, name: str = "", item_name: str = "", concurrency: int = None):
         if not self.pbar:
             return
         if self.pbar.n < self.total:
+            if concurrency is not None:
+                self.pbar.set_postfix(concurrency=concurrency, refresh=False)
             self.pbar.update()
             remaining_total = self.total - self.pbar.n
             remaining_time = get_pbar_remaining(n=self.pbar.n, total=self.total, start_time=self.start_time)
@@ -93,29 +102,18 @@ class UpdateSource:
     # ----------------------------
     # IO: cache
     # ----------------------------
-    def _load_cache(self) -> dict:
-        if not (config.open_history and os.path.exists(constants.cache_path)):
-            return {}
-        try:
-            with gzip.open(constants.cache_path, "rb") as f:
-                return pickle.load(f) or {}
-        except Exception:
-            return {}
-
     def _save_cache(self, cache_result: dict):
-        serializable = to_serializable(cache_result or {})
-        cache_dir = os.path.dirname(constants.cache_path)
-        if cache_dir:
-            os.makedirs(cache_dir, exist_ok=True)
-        with gzip.open(constants.cache_path, "wb") as f:
-            pickle.dump(serializable, f)
+        history.save(constants.history_path, cache_result, format_channel_name)
 
     # ----------------------------
     # stage 1: prepare
     # ----------------------------
     def _prepare_channel_data(self):
+        ip_checker.load_dns_cache(constants.dns_cache_path, config.dns_cache_ttl * 3600)
         self.whitelist_maps = load_whitelist_maps(constants.whitelist_path)
         self.blacklist = get_urls_from_file(constants.blacklist_path, pattern_search=False)
+        if config.open_history:
+            history.migrate(constants.history_path, constants.cache_path, format_channel_name)
         self.channel_items = get_channel_items(self.whitelist_maps, self.blacklist)
         self.channel_data = {}
 
@@ -123,7 +121,7 @@ class UpdateSource:
             name for channel_obj in self.channel_items.values() for name in channel_obj.keys()
         ]
 
-        if config.open_history and os.path.exists(constants.frozen_path):
+        if config.open_history:
             frozen.load(constants.frozen_path)
 
     # ----------------------------
@@ -249,6 +247,8 @@ class UpdateSource:
                 0,
             )
 
+        speed_store.load(constants.speed_store_path, config.speed_test_cache_ttl * 3600,
+                         prior=config.open_speed_test_priority)
         self.start_time = time()
         self.pbar = tqdm(
             total=self.total,
@@ -259,16 +259,29 @@ class UpdateSource:
             dynamic_ncols=False,
         )
         try:
+            callback = lambda **kwargs: self.pbar_update(name=t("pbar.speed_test"), item_name=t("pbar.url"), **kwargs)
+            if config.speed_test_process_num > 1:
+                return await test_speed_sharded(
+                    test_data,
+                    config.speed_test_process_num,
+                    ipv6=self.ipv6_support,
+                    callback=callback,
+                    on_task_complete=self.aggregator.add_item,
+                )
             return await test_speed(
                 test_data,
                 ipv6=self.ipv6_support,
-                callback=lambda: self.pbar_update(name=t("pbar.speed_test"), item_name=t("pbar.url")),
+                callback=callback,
                 on_task_complete=self.aggregator.add_item,
             )
         finally:
             if self.pbar:
                 self.pbar.close()
                 self.pbar = None
+            if store_samples:
+                speed_store.save(constants.speed_store_path)
+            if config.speed_test_cache_ttl > 0:
+                print(t("msg.speed_store_hits").format(hits=speed_stats["store_hits"], total=self.total), flush=True)
 
     # ----------------------------
     # stage 5: ui final notify
@@ -316,6 +329,7 @@ class UpdateSource:
             self.tasks = []
             self._write_epg_files_if_needed()
 
+            await prefetch_total_data_hosts(self.channel_items.items(), self.subscribe_result)
             append_total_data(
                 self.channel_items.items(),
                 self.channel_data,
@@ -323,10 +337,10 @@ class UpdateSource:
                 self.whitelist_maps,
                 self.blacklist,
             )
+            ip_checker.save_dns_cache(constants.dns_cache_path)
 
-            cache = self._load_cache()
-
-            await self._start_aggregator(cache)
+            await self._start_aggregator(history.get_result())
+            history.clear()
             try:
                 if config.open_speed_test:
                     clear_cache()
@@ -337,10 +351,11 @@ class UpdateSource:
                     await self.aggregator.flush_once(force=True)
 
             finally:
+                aggregator = self.aggregator
+                await self._stop_aggregator()
                 if config.open_history:
-                    self._save_cache(self.aggregator.result)
+                    self._save_cache(aggregator.result)
                     frozen.save(constants.frozen_path)
-                await self._stop_aggregator()
 
             print(
                 t("msg.update_completed").format(
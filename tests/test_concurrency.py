@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+
+import utils.concurrency as concurrency
+from utils.concurrency import AdaptiveLimiter, TokenBucket
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(AdaptiveLimiter, "_under_pressure", lambda self: False)
+    return AdaptiveLimiter(8, min_limit=2, max_limit=10)
+
+
+def fill(limiter, delay=0.1, failed=False, saturated=True):
+    limiter._saturated = saturated
+    for _ in range(limiter.limit):
+        limiter.record(delay, failed)
+
+
+def test_adaptive_limiter_clamps_initial():
+    assert AdaptiveLimiter(0, min_limit=0).limit == 1
+    assert AdaptiveLimiter(100, max_limit=50).limit == 50
+    assert AdaptiveLimiter(5, min_limit=8, max_limit=4).limit == 8
+
+
+def test_adaptive_limiter_adjusts_once_per_window(limiter):
+    limiter._saturated = True
+    for _ in range(limiter.limit - 1):
+        limiter.record(0.1)
+    assert limiter.limit == 8
+    limiter.record(0.1)
+    assert limiter.limit == 9
+    assert limiter._samples == 0 and not limiter._saturated
+
+
+def test_adaptive_limiter_grows_only_when_saturated(limiter):
+    fill(limiter, saturated=False)
+    assert limiter.limit == 8
+    fill(limiter)
+    fill(limiter)
+    fill(limiter)
+    assert limiter.limit == 10
+
+
+def test_adaptive_limiter_decreases_on_failures(limiter):
+    fill(limiter)
+    assert limiter.limit == 9
+    fill(limiter, failed=True)
+    assert limiter.limit == int(9 * 0.75)
+    for _ in range(3):
+        fill(limiter, failed=True)
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_decreases_on_delay(limiter):
+    fill(limiter, delay=0.1)
+    assert limiter.limit == 9
+    fill(limiter, delay=0.2)
+    assert limiter.limit == 10
+    fill(limiter, delay=1.0)
+    assert limiter.limit == int(10 * 0.75)
+
+
+def test_adaptive_limiter_baselines_drift(limiter):
+    fill(limiter, delay=0.2)
+    assert limiter._base_delay == pytest.approx(0.2 * 1.05)
+    assert limiter._base_failure_rate == pytest.approx(0.01)
+    fill(limiter, delay=0.1)
+    assert limiter._base_delay == pytest.approx(0.1 * 1.05)
+
+
+def test_adaptive_limiter_marks_saturation():
+    async def run():
+        limiter = AdaptiveLimiter(2)
+        await limiter.acquire()
+        assert not limiter._saturated
+        await limiter.acquire()
+        assert limiter._saturated and limiter.in_flight == 2
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await limiter.release()
+        await waiter
+        assert limiter.in_flight == 2
+
+    asyncio.run(run())
+
+
+def test_adaptive_limiter_release_survives_cancellation():
+    async def run():
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        async with limiter._condition:
+            releaser = asyncio.create_task(limiter.release())
+            await asyncio.sleep(0)
+            releaser.cancel()
+            await asyncio.sleep(0)
+        with pytest.raises(asyncio.CancelledError):
+            await releaser
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_adaptive_limiter_context_releases_on_cancel():
+    async def run():
+        limiter = AdaptiveLimiter(1)
+
+        async def hold():
+            async with limiter:
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        assert limiter.in_flight == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(concurrency.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(concurrency.asyncio, "sleep", sleep)
+    return now, sleeps
+
+
+def test_token_bucket_consumes_within_capacity(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(100)
+    assert bucket.capacity == 100
+    assert asyncio.run(bucket.consume(60)) == 0
+    assert bucket.tokens == 40
+    assert asyncio.run(bucket.consume(40)) == 0
+    assert bucket.tokens == 0
+    assert sleeps == []
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(100, capacity=50)
+    asyncio.run(bucket.consume(50))
+    now[0] += 0.2
+    asyncio.run(bucket.consume(0))
+    assert bucket.tokens == pytest.approx(20)
+    now[0] += 10
+    asyncio.run(bucket.consume(0))
+    assert bucket.tokens == 50
+
+
+def test_token_bucket_waits_for_debt(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(100)
+    assert asyncio.run(bucket.consume(250)) == pytest.approx(1.5)
+    assert sleeps == [pytest.approx(1.5)]
+    assert bucket.tokens == -150
+    assert asyncio.run(bucket.consume(50)) == pytest.approx(0.5)
+    assert bucket.tokens == pytest.approx(-50)
+
+
+def test_token_bucket_long_run_rate(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(1000, capacity=100)
+    start = now[0]
+    for _ in range(50):
+        asyncio.run(bucket.consume(200))
+    assert now[0] - start == pytest.approx((50 * 200 - 100) / 1000)
+
+
+def test_token_bucket_unlimited(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(0)
+    assert asyncio.run(bucket.consume(10 ** 9)) == 0
+    assert sleeps == []
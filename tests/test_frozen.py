@@ -0,0 +1,160 @@
+import gzip
+import os
+import pickle
+
+import pytest
+
+import utils.frozen as frozen
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch):
+    now = [1_000_000]
+    monkeypatch.setattr(frozen, "_now_ts", lambda: now[0])
+    monkeypatch.setattr(frozen, "_frozen", {})
+    monkeypatch.setattr(frozen, "_expiry", [])
+    monkeypatch.setattr(frozen, "_journal_pending", [])
+    monkeypatch.setattr(frozen, "_journal_records", 0)
+    monkeypatch.setattr(frozen, "_snapshot_path", None)
+    return now
+
+
+def reset(monkeypatch):
+    monkeypatch.setattr(frozen, "_frozen", {})
+    monkeypatch.setattr(frozen, "_expiry", [])
+    monkeypatch.setattr(frozen, "_journal_pending", [])
+    monkeypatch.setattr(frozen, "_snapshot_path", None)
+
+
+def snapshot():
+    return {url: entry.to_tuple() for url, entry in frozen._frozen.items()}
+
+
+def test_mark_and_expire(state):
+    frozen.mark_url_bad("a")
+    assert frozen.is_url_frozen("a")
+    assert frozen.get_url_bad_count("a") == 1
+    state[0] += 2 * frozen.BASE_BACKOFF - 1
+    assert frozen.filter_frozen(["a", "b"]) == {"a"}
+    state[0] += 1
+    assert frozen.filter_frozen(["a", "b"]) == set()
+    assert "a" not in frozen._frozen
+
+
+def test_expire_skips_outdated_heap_items(state):
+    frozen.mark_url_bad("a")
+    state[0] += 10
+    frozen.mark_url_bad("a")
+    state[0] += 2 * frozen.BASE_BACKOFF
+    assert frozen.is_url_frozen("a")
+    assert frozen.get_current_frozen_set() == {"a"}
+    state[0] += 4 * frozen.BASE_BACKOFF
+    assert not frozen.is_url_frozen("a")
+    assert frozen.get_url_bad_count("a") == 1
+
+
+def test_evicts_oldest_never_recovered(monkeypatch, state):
+    monkeypatch.setattr(frozen, "MAX_ENTRIES", 10)
+    monkeypatch.setattr(frozen, "EVICT_RATIO", 0.2)
+    for i in range(10):
+        state[0] += 1
+        frozen.mark_url_bad(f"u{i}", initial=True)
+    frozen.mark_url_good("u0")
+    frozen.mark_url_good("u1")
+    assert len(frozen._frozen) == 10
+    state[0] += 1
+    frozen.mark_url_bad("u10")
+    assert set(frozen._frozen) == {"u0", "u1", "u5", "u6", "u7", "u8", "u9", "u10"}
+    frozen.mark_url_bad("u9")
+    assert len(frozen._frozen) == 8
+
+
+def test_journal_replay(monkeypatch, tmp_path, state):
+    path = str(tmp_path / "frozen.gz")
+    frozen.load(path)
+    frozen.mark_url_bad("a")
+    frozen.mark_url_bad("b")
+    frozen.mark_url_bad("c", initial=True)
+    frozen.flush_journal()
+    frozen.mark_url_good("a")
+    frozen.mark_url_good("c")
+    frozen.flush_journal()
+    frozen.mark_url_bad("d")
+    expected = snapshot()
+    expected.pop("d")
+    assert not os.path.exists(path)
+
+    reset(monkeypatch)
+    frozen.load(path)
+    assert snapshot() == expected
+    assert frozen._journal_records == 5
+
+
+def test_journal_replay_stops_at_torn_batch(monkeypatch, tmp_path, state):
+    path = str(tmp_path / "frozen.gz")
+    frozen.load(path)
+    frozen.mark_url_bad("a")
+    frozen.flush_journal()
+    expected = snapshot()
+    frozen.mark_url_bad("b")
+    frozen.flush_journal()
+    journal_path = path + ".journal"
+    os.truncate(journal_path, os.path.getsize(journal_path) - 3)
+
+    reset(monkeypatch)
+    frozen.load(path)
+    assert snapshot() == expected
+
+
+def test_flush_compacts_journal(monkeypatch, tmp_path, state):
+    monkeypatch.setattr(frozen, "JOURNAL_COMPACT_RECORDS", 3)
+    path = str(tmp_path / "frozen.gz")
+    frozen.load(path)
+    for url in ("a", "b", "c"):
+        frozen.mark_url_bad(url)
+    frozen.flush_journal()
+    assert os.path.exists(path)
+    assert os.path.getsize(path + ".journal") == 0
+    assert frozen._journal_records == 0
+    expected = snapshot()
+
+    reset(monkeypatch)
+    frozen.load(path)
+    assert snapshot() == expected
+
+
+def test_save_truncates_journal(monkeypatch, tmp_path, state):
+    path = str(tmp_path / "frozen.gz")
+    frozen.load(path)
+    frozen.mark_url_bad("a")
+    frozen.flush_journal()
+    frozen.mark_url_bad("b")
+    frozen.save(path)
+    assert os.path.getsize(path + ".journal") == 0
+    assert frozen._journal_pending == []
+    expected = snapshot()
+
+    reset(monkeypatch)
+    frozen.load(path)
+    assert snapshot() == expected
+
+
+def test_load_former_dict_format(tmp_path, state):
+    path = str(tmp_path / "frozen.gz")
+    until = state[0] + 100
+    with gzip.open(path, "wb") as f:
+        pickle.dump({
+            "a": {"bad_count": 2, "last_bad": state[0], "last_good": 0, "frozen_until": until},
+            "b": {"bad_count": 1, "last_bad": state[0], "last_good": 5, "frozen_until": None},
+        }, f)
+    frozen.load(path)
+    assert snapshot() == {"a": (2, state[0], 0, until), "b": (1, state[0], 5, None)}
+    assert frozen.get_current_frozen_set() == {"a"}
+
+
+def test_update_entries(state):
+    frozen.mark_url_bad("a")
+    entries = frozen.get_entries(["a", "b", ""])
+    assert entries == {"a": frozen._frozen["a"].to_dict(), "b": None}
+    frozen.update_entries({"a": None, "b": entries["a"]})
+    assert frozen.filter_frozen(["a", "b"]) == {"b"}
@@ -0,0 +1,72 @@
+import m3u8
+import pytest
+
+from utils.speed import parse_hls_playlist, sample_segment_urls
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=1280000,AVERAGE-BANDWIDTH=1000000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+720p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2560000,RESOLUTION=1920x1080
+http://example.com/1080p/index.m3u8
+
+#EXT-X-STREAM-INF:BANDWIDTH=640000
+audio/index.m3u8
+"""
+
+MEDIA_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:100
+#EXTINF:10.0,
+seg100.ts
+#EXTINF:9.5,title
+seg101.ts
+#EXT-X-DISCONTINUITY
+#EXTINF:10,
+http://example.com/seg102.ts?token=a,b
+#EXTINF:8.008,
+seg103.ts
+#EXTINF:10.0,
+seg104.ts
+#EXT-X-ENDLIST
+"""
+
+
+def m3u8_parse(content):
+    playlist = m3u8.loads(content)
+    return {
+        'variants': [
+            {
+                'bandwidth': variant.stream_info.bandwidth or 0,
+                'resolution': "x".join(map(str, variant.stream_info.resolution))
+                if variant.stream_info.resolution else None,
+                'uri': variant.uri,
+            }
+            for variant in playlist.playlists
+        ],
+        'segments': [{'uri': segment.uri, 'duration': segment.duration} for segment in playlist.segments],
+    }
+
+
+@pytest.mark.parametrize("content", [MASTER_PLAYLIST, MEDIA_PLAYLIST, MEDIA_PLAYLIST.replace("\n", "\r\n")])
+def test_parse_hls_playlist_matches_m3u8(content):
+    assert parse_hls_playlist(content) == m3u8_parse(content)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 5, 10])
+def test_parse_hls_playlist_samples_segments(limit):
+    segments = m3u8_parse(MEDIA_PLAYLIST)['segments']
+    assert parse_hls_playlist(MEDIA_PLAYLIST, limit)['segments'] == sample_segment_urls(segments, limit)
+
+
+@pytest.mark.parametrize("content", [
+    "",
+    "seg.ts\n",
+    "#EXTM3U\n#EXT-X-ENDLIST\n",
+    "#EXTM3U\n#EXTINF:10,\n#EXT-X-BYTERANGE:1000@0\nseg.ts\n",
+    "#EXTM3U\n#EXTINF:abc,\nseg.ts\n",
+    "#EXTM3U\nseg.ts\n",
+])
+def test_parse_hls_playlist_falls_back(content):
+    assert parse_hls_playlist(content) is None
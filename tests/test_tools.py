@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+
+import utils.constants as constants
+from utils.config import config
+from utils.tools import get_total_urls_by_prefer
+
+
+def get_total_urls(info_list, ipv_type_prefer, origin_type_prefer, rtmp_type=None, apply_limit=True):
+    """
+    The former single prefer implementation, kept as the reference
+    """
+    ipv_prefer_bool = bool(ipv_type_prefer)
+    origin_prefer_bool = bool(origin_type_prefer)
+    if not ipv_prefer_bool:
+        ipv_type_prefer = ["all"]
+    if not origin_prefer_bool:
+        origin_type_prefer = ["all"]
+    categorized_urls = {origin: {ipv_type: [] for ipv_type in ipv_type_prefer} for origin in origin_type_prefer}
+    total_urls = []
+    for info in info_list:
+        origin, url_ipv_type, extra_info = info["origin"], info["ipv_type"], info.get("extra_info", "")
+        if not origin:
+            continue
+        if origin == "hls":
+            if not rtmp_type or origin in rtmp_type:
+                total_urls.append(info)
+            continue
+        if origin == "whitelist":
+            total_urls.append(info)
+            continue
+        if origin_prefer_bool and (origin not in origin_type_prefer):
+            continue
+        if not extra_info:
+            info["extra_info"] = constants.origin_map[origin]
+        if not origin_prefer_bool:
+            origin = "all"
+        if ipv_prefer_bool:
+            if url_ipv_type in ipv_type_prefer:
+                categorized_urls[origin][url_ipv_type].append(info)
+        else:
+            categorized_urls[origin]["all"].append(info)
+
+    urls_limit = config.urls_limit if apply_limit else None
+    for origin in origin_type_prefer:
+        if urls_limit is not None and len(total_urls) >= urls_limit:
+            break
+        for ipv_type in ipv_type_prefer:
+            if urls_limit is not None and len(total_urls) >= urls_limit:
+                break
+            urls = categorized_urls[origin].get(ipv_type, [])
+            if not urls:
+                continue
+            if urls_limit is None:
+                total_urls.extend(urls)
+            else:
+                total_urls.extend(urls[:urls_limit - len(total_urls)])
+    if urls_limit is not None:
+        total_urls = total_urls[:urls_limit]
+    return total_urls
+
+
+def make_info_list():
+    origins = ["subscribe", "local", "hls", "whitelist", "subscribe", "local", None, "subscribe"]
+    ipv_types = ["ipv4", "ipv6", "ipv4", "ipv6", "ipv6", "ipv4", "ipv4"]
+    return [
+        {
+            "id": i,
+            "url": f"http://host{i}.example.com/{i}.m3u8",
+            "host": f"host{i}.example.com",
+            "origin": origins[i % len(origins)],
+            "ipv_type": ipv_types[i % len(ipv_types)],
+            "resolution": None,
+            "extra_info": "info" if i % 5 == 0 else "",
+        }
+        for i in range(40)
+    ]
+
+
+IPV_TYPE_PREFERS = [[], ["ipv4"], ["ipv6"], ["ipv4", "ipv6"], ["ipv6", "ipv4"]]
+
+
+@pytest.mark.parametrize("urls_limit", [0, 1, 5, 12, 100])
+@pytest.mark.parametrize("apply_limit", [True, False])
+@pytest.mark.parametrize("origin_type_prefer", [[], ["subscribe"], ["local", "subscribe"], ["subscribe", "local"]])
+@pytest.mark.parametrize("rtmp_type", [None, ["hls"], ["other"]])
+def test_get_total_urls_by_prefer_matches_get_total_urls(monkeypatch, urls_limit, apply_limit, origin_type_prefer,
+                                                         rtmp_type):
+    monkeypatch.setattr(type(config), "urls_limit", property(lambda self: urls_limit))
+    info_list = make_info_list()
+    result = get_total_urls_by_prefer(copy.deepcopy(info_list), IPV_TYPE_PREFERS, list(origin_type_prefer),
+                                      rtmp_type, apply_limit)
+    assert list(result) == list(dict.fromkeys(tuple(prefer) for prefer in IPV_TYPE_PREFERS))
+    for prefer in IPV_TYPE_PREFERS:
+        expected = get_total_urls(copy.deepcopy(info_list), list(prefer), list(origin_type_prefer), rtmp_type,
+                                  apply_limit)
+        assert result[tuple(prefer)] == expected
+
@@ -1,12 +1,22 @@
 import asyncio
-import copy
 from collections import defaultdict
 from logging import INFO
 from typing import Any, Dict, Optional, Set, Tuple, Callable, cast
 
 import utils.constants as constants
-from utils.channel import sort_channel_result, generate_channel_statistic, write_channel_to_file, retain_origin
+import utils.frozen as frozen
+import utils.history as history
+from utils.channel import (
+    sort_channel_result,
+    generate_channel_statistic,
+    write_channel_to_file,
+    retain_origin,
+    RenderCache,
+    format_channel_name
+)
+from utils.concurrency import CoalescingWriter
 from utils.config import config
+from utils.i18n import t
 from utils.tools import get_logger, close_logger_handlers
 
 
@@ -32,12 +42,17 @@ class ResultAggregator:
             result=result,
             ipv6_support=ipv6_support
         )
-        self.test_results: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
+        self._test_results: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._snapshots: Dict[Tuple[str, str], Tuple[int, Tuple[Any, ...]]] = {}
+        self.render_cache = RenderCache()
+        self._writer = CoalescingWriter(self._write_result, merge=self._merge_write_args, name="result-writer")
         self._dirty = False
         self._dirty_count = 0
         self._stopped = True
         self._task: Optional[asyncio.Task] = None
         self.realtime_write = config.open_realtime_write
+        self.persist_history = config.open_history
         self.write_interval = write_interval
         self.first_channel_name = first_channel_name
         self.ipv6_support = ipv6_support
@@ -51,6 +66,30 @@ class ResultAggregator:
         self._pending_channels: Set[Tuple[str, str]] = set()
         self._finished_channels: Set[Tuple[str, str]] = set()
 
+    @property
+    def test_results(self) -> Dict[str, Dict[str, list]]:
+        return self._test_results
+
+    @test_results.setter
+    def test_results(self, value: Dict[str, Dict[str, list]]) -> None:
+        self._test_results = value
+        self._versions.clear()
+        self._snapshots.clear()
+
+    def _get_snapshot(self, cate: str, name: str) -> Tuple[Any, ...]:
+        """
+        Get the immutable snapshot of the results of a channel, materialised again only when
+        the channel changed since its last snapshot.
+        """
+        key = (cate, name)
+        version = self._versions.get(key, 0)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None or snapshot[0] != version:
+            items = self.test_results.get(cate, {}).get(name, [])
+            snapshot = (version, tuple(it.copy() if isinstance(it, dict) else it for it in items))
+            self._snapshots[key] = snapshot
+        return snapshot[1]
+
     def _ensure_debounce_task_in_loop(self, loop: asyncio.AbstractEventLoop) -> None:
         """
         Ensure the debounce task is running in the specified event loop.
@@ -78,6 +117,7 @@ class ResultAggregator:
         Add a test result item for a specific category and name.
         """
         self.test_results[cate][name].append(item)
+        self._versions[(cate, name)] = self._versions.get((cate, name), 0) + 1
         self.is_last = is_last
         self._pending_channels.add((cate, name))
 
@@ -169,31 +209,59 @@ class ResultAggregator:
             except Exception:
                 new_sorted = defaultdict(lambda: defaultdict(list))
 
+        # The sorted lists are shared instead of copied: they are never changed in place,
+        # which keeps the identity of unchanged channels stable for the total urls cache
         merged = defaultdict(lambda: defaultdict(list))
 
         for cate, names in self.base_data.items():
             for name in names.keys():
-                merged[cate][name] = list(self.result.get(cate, {}).get(name, []))
+                merged[cate][name] = self.result.get(cate, {}).get(name, [])
 
         for cate, names in new_sorted.items():
             if cate not in self.base_data:
                 continue
             for name, vals in names.items():
                 if name in self.base_data.get(cate, {}) and vals:
-                    merged[cate][name] = list(vals)
+                    merged[cate][name] = vals
 
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None,
-            write_channel_to_file,
+        self.result = merged
+        # The history rows are serialized here, the items may be changed on the loop while the writer runs
+        history_blobs = history.serialize(merged, affected) if self.persist_history else None
+        await asyncio.wrap_future(self._writer.submit(
+            history_blobs,
             merged,
             self.ipv6_support,
             self.first_channel_name,
             True,
             self.is_last,
-        )
+            self.render_cache,
+            affected,
+        ))
 
-        self.result = merged
+    def _write_result(self, history_blobs, *args):
+        """
+        Write the result files in the writer thread, then persist the changed channels and frozen state
+        so that a crash loses at most this batch
+        """
+        rtmp_rows = write_channel_to_file(*args)
+        if rtmp_rows and self.stat_logger:
+            self.stat_logger.info(t("msg.rtmp_rows_written").format(upserted=rtmp_rows[0], deleted=rtmp_rows[1]))
+        if history_blobs is not None:
+            history.update(constants.history_path, history_blobs, format_channel_name)
+            frozen.flush_journal()
+        return rtmp_rows
+
+    @staticmethod
+    def _merge_write_args(pending: tuple, latest: tuple) -> tuple:
+        """
+        Merge a replaced write into the latest one: the channels changed by both have to be rendered again,
+        and the history rows of the replaced write are kept unless the latest one has newer ones
+        """
+        pending_dirty, latest_dirty = pending[-1], latest[-1]
+        dirty = None if pending_dirty is None or latest_dirty is None else pending_dirty | latest_dirty
+        pending_blobs, latest_blobs = pending[0], latest[0]
+        blobs = None if latest_blobs is None else {**(pending_blobs or {}), **latest_blobs}
+        return blobs, *latest[1:-1], dirty
 
     async def _debounce_loop(self):
         """
@@ -225,17 +293,18 @@ class ResultAggregator:
             pending = set(self._pending_channels)
             self._pending_channels.clear()
 
+            test_copy = defaultdict(lambda: defaultdict(list))
             if force:
-                test_copy = copy.deepcopy(self.test_results)
+                for cate, names in self.test_results.items():
+                    for name in names:
+                        test_copy[cate][name] = self._get_snapshot(cate, name)
                 finished_for_flush = set(self._finished_channels)
                 self._finished_channels.clear()
             else:
-                test_copy = defaultdict(lambda: defaultdict(list))
                 for cate, name in pending:
-                    items = self.test_results.get(cate, {}).get(name, [])
-                    copied_items = [it.copy() if isinstance(it, dict) else it for it in items]
-                    if copied_items:
-                        test_copy[cate][name] = copied_items
+                    snapshot = self._get_snapshot(cate, name)
+                    if snapshot:
+                        test_copy[cate][name] = snapshot
 
                 finished_for_flush = set(self._finished_channels & pending)
                 self._finished_channels.difference_update(finished_for_flush)
@@ -295,5 +364,13 @@ class ResultAggregator:
             except asyncio.CancelledError:
                 pass
             self._debounce_task = None
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.close)
         if self.stat_logger:
+            if self._writer.writes:
+                self.stat_logger.info(t("msg.result_write_stats").format(
+                    writes=self._writer.writes,
+                    coalesced=self._writer.coalesced,
+                    avg=self._writer.write_time / self._writer.writes,
+                    max=self._writer.max_write_time,
+                ))
             close_logger_handlers(self.stat_logger)
@@ -1,36 +1,39 @@
 import asyncio
-import gzip
-import hashlib
 import json
 import math
 import os
-import pickle
 import re
 import tempfile
 from collections import defaultdict, Counter, OrderedDict
+from contextlib import nullcontext
 from itertools import chain
 from logging import INFO
 from typing import cast
 
 import utils.constants as constants
+import utils.history as history
+import utils.speed_store as speed_store
 from utils.alias import Alias
+from utils.concurrency import AdaptiveLimiter
 from utils.config import config
 from utils.db import ensure_result_data_schema
 from utils.db import get_db_connection, return_db_connection
-from utils.ffmpeg import check_ffmpeg_installed_status
-from utils.frozen import is_url_frozen, mark_url_bad, mark_url_good
+from utils.ffmpeg import check_ffmpeg_installed_status, subprocess_stats
+from utils.frozen import filter_frozen, mark_url_bad, mark_url_good, get_url_bad_count
 from utils.i18n import t
 from utils.ip_checker import IPChecker
 from utils.speed import (
     get_speed,
     get_speed_result,
-    get_sort_result
+    get_sort_result,
+    create_speed_test_session,
+    stats as speed_stats
 )
 from utils.tools import (
     format_name,
     get_name_value,
     check_url_by_keywords,
-    get_total_urls,
+    get_total_urls_by_prefer,
     add_url_info,
     resource_path,
     get_name_urls_from_file,
@@ -38,7 +41,7 @@ from utils.tools import (
     get_datetime_now,
     get_url_host,
     check_ipv_type_match,
-    convert_to_m3u,
+    M3UEmitter,
     custom_print,
     get_name_uri_from_dir,
     get_resolution_value,
@@ -66,73 +69,84 @@ open_local = config.open_local
 open_rtmp = config.open_rtmp
 retain_origin = ["whitelist", "hls"]
 
-_TOTAL_URLS_CACHE_MAX_SIZE = 2048
-_TOTAL_URLS_CACHE = OrderedDict()
-
-
-def _build_total_urls_signature(info_list: list[ChannelData]) -> str:
-    """
-    Build a stable signature for a channel info list.
-    """
-    hasher = hashlib.sha1()
-    for info in info_list or []:
-        if not isinstance(info, dict):
-            hasher.update(repr(info).encode("utf-8", errors="ignore"))
-            hasher.update(b"\x1e")
-            continue
-
-        origin = info.get("origin") or ""
-        extra_info = info.get("extra_info") or ""
-        if origin not in retain_origin and not extra_info:
-            extra_info = constants.origin_map.get(origin, "")
-
-        hasher.update(
-            "\x1f".join((
-                str(info.get("id", "")),
-                info.get("url") or "",
-                origin,
-                info.get("ipv_type") or "",
-                extra_info,
-            )).encode("utf-8", errors="ignore")
-        )
-        hasher.update(b"\x1e")
-
-    return hasher.hexdigest()
+_TOTAL_URLS_CACHE_MAX_URLS = 200000
+_TOTAL_URLS_CACHE: OrderedDict[tuple, tuple[list, dict[tuple, tuple], int]] = OrderedDict()
+_total_urls_cache_size = 0
+_RTMP_ROW_HASHES: dict[str, dict[str, int | None]] = {}
 
 
 def _get_total_urls_cached(
         info_list: list[ChannelData],
-        ipv_type_prefer,
+        ipv_type_prefers,
         origin_type_prefer,
         rtmp_type=None,
         apply_limit: bool = True,
-) -> tuple:
+) -> dict[tuple, tuple]:
     """
-    Cached wrapper for `get_total_urls()`.
+    Cached wrapper for `get_total_urls_by_prefer()`, keyed by the identity and the length of the info list.
+    The lists of the written data are replaced instead of changed in place, and the cache holds a reference
+    to each list so its id cannot be reused, so a lookup is O(1). The cache is bounded by the number of urls
+    it keeps alive rather than by its number of entries.
     """
-    ipv_key = tuple(ipv_type_prefer or ())
-    origin_key = tuple(origin_type_prefer or ())
-    rtmp_key = tuple(rtmp_type or ())
+    global _total_urls_cache_size
+    ipv_keys = tuple(tuple(ipv_type_prefer or ()) for ipv_type_prefer in ipv_type_prefers)
     cache_key = (
-        _build_total_urls_signature(info_list),
-        ipv_key,
-        origin_key,
-        rtmp_key,
+        id(info_list),
+        len(info_list),
+        ipv_keys,
+        tuple(origin_type_prefer or ()),
+        tuple(rtmp_type or ()),
         bool(apply_limit),
         config.urls_limit,
     )
     cached = _TOTAL_URLS_CACHE.get(cache_key)
-    if cached is not None:
+    if cached is not None and cached[0] is info_list:
         _TOTAL_URLS_CACHE.move_to_end(cache_key)
-        return cached
+        return cached[1]
 
-    total_urls = tuple(get_total_urls(info_list, ipv_type_prefer, origin_type_prefer, rtmp_type, apply_limit))
-    _TOTAL_URLS_CACHE[cache_key] = total_urls
-    if len(_TOTAL_URLS_CACHE) > _TOTAL_URLS_CACHE_MAX_SIZE:
-        _TOTAL_URLS_CACHE.popitem(last=False)
+    total_urls = {
+        ipv_key: tuple(urls) for ipv_key, urls in
+        get_total_urls_by_prefer(info_list, ipv_keys, origin_type_prefer, rtmp_type, apply_limit).items()
+    }
+    size = len(info_list) + sum(len(urls) for urls in total_urls.values())
+    if cached is not None:
+        _total_urls_cache_size -= cached[2]
+    _TOTAL_URLS_CACHE[cache_key] = (info_list, total_urls, size)
+    _total_urls_cache_size += size
+    while _total_urls_cache_size > _TOTAL_URLS_CACHE_MAX_URLS and len(_TOTAL_URLS_CACHE) > 1:
+        _, (_, _, evicted_size) = _TOTAL_URLS_CACHE.popitem(last=False)
+        _total_urls_cache_size -= evicted_size
     return total_urls
 
 
+class RenderCache:
+    """
+    Cache of the rendered txt and m3u fragments of every (category, channel, variant) of the result files,
+    the fragments of a channel are dropped when it is marked dirty and rendered again on the next write
+    """
+
+    def __init__(self):
+        self._fragments: dict[tuple, tuple[str, str, tuple]] = {}
+
+    def get(self, cate: str, name: str, variant: tuple):
+        return self._fragments.get((cate, name, variant))
+
+    def set(self, cate: str, name: str, variant: tuple, fragment: tuple[str, str, tuple]) -> None:
+        self._fragments[(cate, name, variant)] = fragment
+
+    def invalidate(self, channels=None) -> None:
+        """
+        Drop the fragments of the (category, channel) pairs, or all of them when channels is None
+        """
+        if channels is None:
+            self._fragments.clear()
+            return
+        channels = set(channels)
+        if channels:
+            for key in [key for key in self._fragments if key[:2] in channels]:
+                self._fragments.pop(key, None)
+
+
 def format_channel_data(url: str, origin: OriginType) -> ChannelData:
     """
     Format the channel data
@@ -294,7 +308,8 @@ def get_channel_data_from_file(channels, file, whitelist_maps, blacklist,
 
 def get_channel_items(whitelist_maps, blacklist) -> CategoryChannelData:
     """
-    Get the channel items from the source file
+    Get the channel items from the source file, merged with the history of the same channels.
+    Only the history of the channel names in the source file is read, unless the unmatched channels are kept
     """
     user_source_file = resource_path(config.source_file)
     channels = defaultdict(lambda: defaultdict(list))
@@ -324,7 +339,11 @@ def get_channel_items(whitelist_maps, blacklist) -> CategoryChannelData:
         for name in data.keys():
             source_name_targets[format_channel_name(name)].append((cate, name))
 
-    if config.open_history and os.path.exists(constants.cache_path):
+    history_result = history.load(
+        constants.history_path,
+        None if config.open_unmatch_category else list(source_name_targets)
+    ) if config.open_history else {}
+    if history_result:
         unmatched_history = defaultdict(list)
 
         def _append_history_items(channel_data, info_list):
@@ -346,24 +365,22 @@ def get_channel_items(whitelist_maps, blacklist) -> CategoryChannelData:
                     urls.append(info_url)
 
         try:
-            with gzip.open(constants.cache_path, "rb") as file:
-                old_result = pickle.load(file) or {}
-                for cate, data in old_result.items():
-                    for name, info_list in data.items():
-                        targets = source_name_targets.get(format_channel_name(name))
-                        if targets:
-                            for target_cate, target_name in targets:
-                                channel_data = channels[target_cate][target_name]
-                                _append_history_items(channel_data, info_list)
-                                if not channel_data:
-                                    for info in info_list:
-                                        old_result_url = info.get("url") if info else None
-                                        if info and info.get(
-                                                "origin") not in retain_origin and old_result_url and not check_url_by_keywords(
-                                            old_result_url, blacklist):
-                                            channel_data.append(info)
-                        else:
-                            unmatched_history[name].extend(info_list)
+            for cate, data in history_result.items():
+                for name, info_list in data.items():
+                    targets = source_name_targets.get(format_channel_name(name))
+                    if targets:
+                        for target_cate, target_name in targets:
+                            channel_data = channels[target_cate][target_name]
+                            _append_history_items(channel_data, info_list)
+                            if not channel_data:
+                                for info in info_list:
+                                    old_result_url = info.get("url") if info else None
+                                    if info and info.get(
+                                            "origin") not in retain_origin and old_result_url and not check_url_by_keywords(
+                                        old_result_url, blacklist):
+                                        channel_data.append(info)
+                    else:
+                        unmatched_history[name].extend(info_list)
         except Exception as e:
             print(t("msg.error_load_cache").format(info=e))
 
@@ -455,6 +472,16 @@ def append_data_to_info_data(
     channel_list = info_data[category][name]
     existing_map = {info["url"]: idx for idx, info in enumerate(channel_list) if "url" in info}
 
+    normalized_urls = {}
+    for item in data:
+        try:
+            raw_url = item.get("url")
+            if raw_url and item.get("origin", origin) not in retain_origin and raw_url not in normalized_urls:
+                normalized_urls[raw_url] = get_channel_url(raw_url)
+        except Exception:
+            pass
+    frozen_urls = filter_frozen(url for url in normalized_urls.values() if url)
+
     for item in data:
         try:
             channel_id = item.get("id") or hash(item["url"])
@@ -477,10 +504,10 @@ def append_data_to_info_data(
 
             normalized_url = raw_url
             if url_origin not in retain_origin:
-                normalized_url = get_channel_url(raw_url)
+                normalized_url = normalized_urls.get(raw_url)
                 if not normalized_url:
                     continue
-                if is_url_frozen(normalized_url):
+                if normalized_url in frozen_urls:
                     continue
                 if blacklist and check_url_by_keywords(normalized_url, blacklist):
                     continue
@@ -617,6 +644,24 @@ def print_channel_number(data: CategoryChannelData, cate: str, name: str):
     )
 
 
+async def prefetch_total_data_hosts(items, subscribe_result=None):
+    """
+    Resolve the hosts of all the data to append concurrently and look up the location and ISP of their IPs,
+    ahead of the synchronous append_total_data
+    """
+    if not config.open_method["subscribe"]:
+        subscribe_result = None
+    infos = [
+        info
+        for channel_obj in chain((channel_obj for _, channel_obj in items), [subscribe_result or {}])
+        for info_list in channel_obj.values()
+        for info in info_list or []
+        if info and info.get("url") and info.get("origin") not in retain_origin
+    ]
+    await ip_checker.prefetch([info["url"] for info in infos])
+    ip_checker.prefetch_maps([info["url"] for info in infos if not info.get("location") or not info.get("isp")])
+
+
 def append_total_data(
         items,
         data,
@@ -728,28 +773,141 @@ def is_valid_speed_result(info) -> bool:
         return False
 
 
-async def test_speed(data, ipv6=False, callback=None, on_task_complete=None):
+def get_speed_test_host(info):
+    """
+    Get the host used to group the speed test tasks
+    """
+    return info.get("host") or get_url_host(info.get("url") or "") or info.get("url")
+
+
+def interleave_by_host(host_queues):
+    """
+    Yield the items of the host queues in round-robin order, so consecutive items come from different hosts
+    """
+    queues = [iter(queue) for queue in host_queues.values()]
+    while queues:
+        remaining = []
+        for queue in queues:
+            item = next(queue, None)
+            if item is not None:
+                yield item
+                remaining.append(queue)
+        queues = remaining
+
+
+def get_prior_result(info):
+    """
+    Get the last known speed test result of the channel info, from the speed store or the history cache
+    """
+    key = info.get("host") if config.speed_test_filter_host else info.get("url")
+    stored = speed_store.get_fresh_result(key, math.inf)
+    if stored:
+        return stored
+    if info.get("speed") is not None or info.get("delay") is not None:
+        return info
+    return None
+
+
+def get_speed_test_priority(info, host_success_rate):
+    """
+    Get the sort key of the channel info for the prioritised speed test dispatch, smaller runs first
+    """
+    origin = info.get("origin")
+    origin_rank = 0 if origin == "whitelist" else 1 if origin in ("local", "hls") else 2
+    score = host_success_rate.get(get_speed_test_host(info), 0.5)
+    prior = get_prior_result(info)
+    if prior:
+        if check_channel_need_frozen(prior):
+            score -= 1
+        else:
+            speed = prior.get("speed") or 0
+            delay = prior.get("delay") or 0
+            score += 1 + min(speed, 10) / 10 - min(delay, 5000) / 10000
+    score -= 0.5 * get_url_bad_count(info.get("url"))
+    return origin_rank, -score
+
+
+def get_host_success_rate(items):
+    """
+    Get the success rate of every host from the last known results and the frozen state of its urls
+    """
+    host_counts = defaultdict(lambda: [0, 0])
+    for info in items:
+        counts = host_counts[get_speed_test_host(info)]
+        prior = get_prior_result(info)
+        if prior:
+            counts[1] += 1
+            if not check_channel_need_frozen(prior):
+                counts[0] += 1
+        if bad_count := get_url_bad_count(info.get("url")):
+            counts[1] += bad_count
+    return {host: good / total for host, (good, total) in host_counts.items() if total}
+
+
+def order_speed_test_items(items, prioritize=False):
+    """
+    Order the speed test items: round-robin across hosts, and with prioritize, the best candidates
+    of every channel first, so the early exit of a channel is reached with fewer probes
+    """
+    if not prioritize:
+        host_queues = defaultdict(list)
+        for item in items:
+            host_queues[get_speed_test_host(item[2])].append(item)
+        return list(interleave_by_host(host_queues))
+
+    host_success_rate = get_host_success_rate([info for _, _, info in items])
+    channel_items = defaultdict(list)
+    for item in items:
+        channel_items[(item[0], item[1])].append(item)
+    rank_queues = defaultdict(lambda: defaultdict(list))
+    for channel_list in channel_items.values():
+        channel_list.sort(key=lambda item: get_speed_test_priority(item[2], host_success_rate))
+        for rank, item in enumerate(channel_list):
+            rank_queues[rank][get_speed_test_host(item[2])].append(item)
+    return [item for rank in sorted(rank_queues) for item in interleave_by_host(rank_queues[rank])]
+
+
+async def test_speed(data, ipv6=False, callback=None, on_task_complete=None, on_start=None, shard=False):
     """
     Test speed of channel data
+    :param on_start: called with a function cancelling the remaining tasks of a channel once all tasks are created
+    :param shard: run as a shard of the sharded mode, the logs are appended and the run statistic is left to the parent
     """
     ipv6_proxy_url = None if (not config.open_ipv6 or ipv6) else constants.ipv6_proxy
     open_headers = config.open_headers
     open_full_speed_test = config.open_full_speed_test
     get_resolution = config.open_filter_resolution and check_ffmpeg_installed_status()
-    semaphore = asyncio.Semaphore(config.speed_test_limit)
-    logger = get_logger(constants.speed_test_log_path, level=INFO, init=True)
-    result_logger = get_logger(constants.result_log_path, level=INFO, init=True)
+    if config.open_speed_test_adaptive:
+        semaphore = AdaptiveLimiter(
+            config.speed_test_limit,
+            min_limit=config.speed_test_min_limit,
+            max_limit=config.speed_test_max_limit,
+        )
+    else:
+        semaphore = asyncio.Semaphore(config.speed_test_limit)
+    host_limit = config.speed_test_host_limit
+    host_semaphores = defaultdict(lambda: asyncio.Semaphore(host_limit))
+    logger = get_logger(constants.speed_test_log_path, level=INFO, init=not shard)
+    result_logger = get_logger(constants.result_log_path, level=INFO, init=not shard)
+
+    session = create_speed_test_session()
 
     async def limited_get_speed(channel_info):
-        async with semaphore:
+        host_semaphore = host_semaphores[get_speed_test_host(channel_info)] if host_limit > 0 else nullcontext()
+        async with host_semaphore, semaphore:
             headers = (open_headers and channel_info.get("headers")) or None
-            return await get_speed(
+            result = await get_speed(
                 channel_info,
                 headers=headers,
                 ipv6_proxy=ipv6_proxy_url,
                 filter_resolution=get_resolution,
                 logger=logger,
+                session=session,
             )
+            delay = result.get("delay")
+            if isinstance(semaphore, AdaptiveLimiter) and delay is not None and not result.get("stored"):
+                semaphore.record(delay, failed=delay == -1)
+            return result
 
     total_tasks = sum(len(info_list) for channel_obj in data.values() for info_list in channel_obj.values())
     total_tasks_by_channel = defaultdict(int)
@@ -798,12 +956,14 @@ async def test_speed(data, ipv6=False, callback=None, on_task_complete=None):
         if name not in grouped_results[cate]:
             grouped_results[cate][name] = []
         merged = {**info, **result}
+        stored = merged.pop("stored", False)
         grouped_results[cate][name].append(merged)
 
-        if check_channel_need_frozen(merged):
-            mark_url_bad(merged.get("url"))
-        else:
-            mark_url_good(merged.get("url"))
+        if not task.cancelled() and not stored and merged.get("delay") is not None:
+            if check_channel_need_frozen(merged):
+                mark_url_bad(merged.get("url"))
+            else:
+                mark_url_good(merged.get("url"))
 
         is_valid = is_valid_speed_result(merged)
         if is_valid:
@@ -841,22 +1001,43 @@ async def test_speed(data, ipv6=False, callback=None, on_task_complete=None):
 
         if callback:
             try:
-                callback()
+                if isinstance(semaphore, AdaptiveLimiter):
+                    callback(concurrency=semaphore.limit)
+                else:
+                    callback()
             except Exception:
                 pass
 
+    items = []
     for cate, channel_obj in data.items():
         for name, info_list in channel_obj.items():
             for info in info_list:
                 info['name'] = name
-                task = asyncio.create_task(limited_get_speed(info))
-                channel_map[task] = (cate, name, info)
-                task.add_done_callback(_on_task_done)
-                tasks.append(task)
+                items.append((cate, name, info))
+
+    for cate, name, info in order_speed_test_items(items, prioritize=config.open_speed_test_priority):
+        task = asyncio.create_task(limited_get_speed(info))
+        channel_map[task] = (cate, name, info)
+        task.add_done_callback(_on_task_done)
+        tasks.append(task)
 
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+    if on_start:
+        on_start(_cancel_remaining_channel_tasks)
 
+    try:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await session.close()
+
+    if not shard:
+        try:
+            generate_speed_test_statistic(
+                get_logger(constants.statistic_log_path, level=INFO),
+                {**speed_stats, **subprocess_stats}
+            )
+        except Exception:
+            pass
     close_logger_handlers(logger)
     close_logger_handlers(result_logger)
     return grouped_results
@@ -965,154 +1146,286 @@ def generate_channel_statistic(logger, cate, name, values):
         print(f"📊 {content}")
 
 
-def process_write_content(
-        path: str,
+def generate_speed_test_statistic(logger, run_stats):
+    """
+    Generate the statistic of the whole speed test run
+    """
+    if not run_stats:
+        return
+    content = f"{t('pbar.speed_test')}: " + ", ".join(
+        f"{t(f'name.{key}')}: {f'{value:.2f}' if isinstance(value, float) else value}"
+        for key, value in run_stats.items()
+    )
+    logger.info(content)
+    print(f"📊 {content}")
+
+
+def _render_channel_fragment(cate, name, channel_urls, hls_url, open_url_info,
+                             emitter: M3UEmitter) -> tuple[str, str, tuple]:
+    """
+    Render the txt and m3u fragment of the urls of a channel, return them with the urls
+    """
+    txt_parts = []
+    m3u_parts = []
+    for item in channel_urls:
+        item_url = item["url"]
+        if open_url_info and item["extra_info"]:
+            item_url = add_url_info(item_url, item["extra_info"])
+        total_item_url = f"{hls_url}/{item['id']}.m3u8" if hls_url else item_url
+        txt_parts.append(f"\n{name},{total_item_url}")
+        # The catchup attributes and headers are only attached to the entries whose link is the plain url,
+        # the hls links and the links with the url info appended never carried them
+        m3u_parts.append(emitter.entry(name, total_item_url, cate, item if total_item_url == item["url"] else None))
+    return "".join(txt_parts), "".join(m3u_parts), channel_urls
+
+
+class ResultFileWriter:
+    """
+    Buffered writer of a txt result file and its m3u file, both written into temporary files
+    that replace the targets when the writer is closed
+    """
+
+    def __init__(self, path, emitter: M3UEmitter, hls_url=None, ipv_type_prefer=None, origin_type_prefer=None,
+                 enable_log=False, update_time_top=False):
+        self.path = path
+        self.emitter = emitter
+        self.hls_url = hls_url
+        self.ipv_key = tuple(ipv_type_prefer or ())
+        self.variant = (hls_url or "", self.ipv_key, tuple(origin_type_prefer or ()))
+        self.enable_log = enable_log
+        self.no_result_name = []
+        self.update_time_item = None
+        self._first_cate = True
+        self._pending = [] if update_time_top else None
+        self._targets = [path, os.path.splitext(path)[0] + ".m3u"]
+        self._txt = self._open(self._targets[0])
+        self._m3u = self._open(self._targets[1])
+        self._m3u.write(emitter.header)
+
+    @staticmethod
+    def _open(path):
+        target_dir = os.path.dirname(path) or "."
+        os.makedirs(target_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", delete=False, dir=target_dir,
+                                           prefix=os.path.basename(path) + ".tmp.", buffering=1 << 16)
+
+    def _write(self, txt, m3u=""):
+        if self._pending is not None:
+            self._pending.append((txt, m3u))
+            return
+        self._txt.write(txt)
+        if m3u:
+            self._m3u.write(m3u)
+
+    def write_category(self, cate):
+        self._write(f"{'\n\n' if not self._first_cate else ''}{cate},#genre#")
+        self._first_cate = False
+
+    def write_channel(self, name, txt_fragment, m3u_fragment, channel_urls, open_empty_category=False):
+        if not channel_urls:
+            if open_empty_category:
+                self.no_result_name.append(name)
+            return
+        if self.update_time_item is None:
+            self.update_time_item = channel_urls[0]
+        self._write(txt_fragment, m3u_fragment)
+
+    def _get_update_time_section(self, update_time, open_url_info, first_channel_name):
+        title, now = update_time
+        item = self.update_time_item or {"id": "id", "url": "url"}
+        item_url = item["url"]
+        if open_url_info and item.get("extra_info"):
+            item_url = add_url_info(item_url, item["extra_info"])
+        value = f"{self.hls_url}/{item["id"]}.m3u8" if self.hls_url else item_url
+        return title, now, value, self.emitter.entry(now, value, title, None, first_channel_name)
+
+    def close(self, is_last=False, open_empty_category=False, update_time=None, open_url_info=False,
+              first_channel_name=None):
+        """
+        Write the no result and update time sections and move the files into place
+        :param update_time: the (title, time) of the update time section, None to skip it
+        """
+        pending, self._pending = self._pending, None
+        if update_time and pending is not None:
+            title, now, value, entry = self._get_update_time_section(update_time, open_url_info, first_channel_name)
+            self._txt.write(f"{title},#genre#\n{now},{value}\n\n")
+            self._m3u.write(entry)
+        for txt, m3u in pending or []:
+            self._write(txt, m3u)
+        if open_empty_category and self.no_result_name and is_last:
+            custom_print.disable = not self.enable_log
+            custom_print(f"\n{t("msg.no_result_channel")}")
+            no_result_title = t("content.no_result_channel")
+            self._write(f"\n\n{no_result_title},#genre#")
+            for i, name in enumerate(self.no_result_name):
+                end_char = ", " if i < len(self.no_result_name) - 1 else ""
+                custom_print(name, end=end_char)
+                self._write(f"\n{name},url", self.emitter.entry(name, "url", no_result_title))
+        if update_time and pending is None:
+            title, now, value, entry = self._get_update_time_section(update_time, open_url_info, first_channel_name)
+            self._write(f"\n\n{title},#genre#\n{now},{value}", entry)
+        for file, target in zip((self._txt, self._m3u), self._targets):
+            file.close()
+            os.replace(file.name, target)
+            try:
+                os.chmod(target, 0o644)
+            except Exception:
+                pass
+
+    def abort(self):
+        for file in (self._txt, self._m3u):
+            try:
+                file.close()
+                os.remove(file.name)
+            except Exception:
+                pass
+
+
+def _write_rtmp_result_data(items) -> tuple[int, int]:
+    """
+    Write the data of the hls result urls into the rtmp database: only the rows changed since the last write
+    are upserted, in one transaction with the deletion of the ids no longer in the result
+    :return: the number of the upserted and the deleted rows
+    """
+    db_path = constants.rtmp_data_path
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+
+    rows = {}
+    for item in items:
+        row_id = str(item.get("id"))
+        rows[row_id] = (
+            row_id,
+            item.get("url"),
+            json.dumps(item.get("headers", None)),
+            item.get("video_codec"),
+            item.get("audio_codec"),
+            item.get("resolution"),
+            item.get("fps"),
+        )
+
+    try:
+        ensure_result_data_schema(db_path)
+        conn = get_db_connection(db_path)
+    except Exception as e:
+        print(t("msg.write_error").format(info=f"open rtmp db error: {e}"))
+        return 0, 0
+    written_hashes = _RTMP_ROW_HASHES.pop(db_path, None)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS result_data (id TEXT PRIMARY KEY, url TEXT, headers TEXT, video_codec TEXT, audio_codec TEXT, resolution TEXT, fps REAL)"
+        )
+        if written_hashes is None:
+            written_hashes = {row_id: None for (row_id,) in cursor.execute("SELECT id FROM result_data")}
+        row_hashes = {row_id: hash(row) for row_id, row in rows.items()}
+        changed_rows = [row for row_id, row in rows.items() if written_hashes.get(row_id) != row_hashes[row_id]]
+        deleted_ids = [(row_id,) for row_id in written_hashes if row_id not in rows]
+        if changed_rows:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO result_data (id, url, headers, video_codec, audio_codec, resolution, fps) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                changed_rows
+            )
+        if deleted_ids:
+            cursor.executemany("DELETE FROM result_data WHERE id=?", deleted_ids)
+        conn.commit()
+        _RTMP_ROW_HASHES[db_path] = row_hashes
+        return len(changed_rows), len(deleted_ids)
+    finally:
+        return_db_connection(db_path, conn)
+
+
+def process_write_files(
         data: CategoryChannelData,
-        hls_url: str = None,
+        file_list: list[dict],
         open_empty_category: bool = False,
-        ipv_type_prefer: list[str] = None,
         origin_type_prefer: list[str] = None,
         first_channel_name: str = None,
-        enable_log: bool = False,
         is_last: bool = False,
+        render_cache: RenderCache = None,
 ):
     """
-    Get channel write content
-    :param path: write into path
+    Write the channel data into all the result files in a single pass: the urls of every channel are
+    classified once into all the variants of the files, and each file is streamed through a buffered writer
     :param data: channel data
-    :param hls_url: hls url
+    :param file_list: the result files, with their path, hls_url, ipv_type_prefer and enable_log
     :param open_empty_category: show empty category
-    :param ipv_type_prefer: ipv type prefer
     :param origin_type_prefer: origin type prefer
     :param first_channel_name: the first channel name
-    :param enable_log: enable log
     :param is_last: is last write
+    :param render_cache: the cache of the rendered channel fragments
+    :return: the number of the upserted and the deleted rows of the rtmp database, None without hls result files
     """
-    content = ""
-    no_result_name = []
-    first_cate = True
-    result_data = defaultdict(list)
-    custom_print.disable = not enable_log
-    rtmp_type = ["hls"] if hls_url else []
     open_url_info = config.open_url_info
     unmatch_category = t("content.unmatch_channel")
-    for cate, channel_obj in data.items():
-        content += f"{'\n\n' if not first_cate else ''}{cate},#genre#"
-        first_cate = False
-        channel_obj_keys = channel_obj.keys()
-        for i, name in enumerate(channel_obj_keys):
-            info_list = data.get(cate, {}).get(name, [])
-            channel_urls = _get_total_urls_cached(
-                info_list,
-                ipv_type_prefer,
-                origin_type_prefer,
-                rtmp_type,
-                apply_limit=cate != unmatch_category,
-            )
-            result_data[name].extend(channel_urls)
-            if not channel_urls:
-                if open_empty_category:
-                    no_result_name.append(name)
-                continue
-            for item in channel_urls:
-                item_url = item["url"]
-                if open_url_info and item["extra_info"]:
-                    item_url = add_url_info(item_url, item["extra_info"])
-                total_item_url = f"{hls_url}/{item['id']}.m3u8" if hls_url else item_url
-                content += f"\n{name},{total_item_url}"
-    if open_empty_category and no_result_name and is_last:
-        custom_print(f"\n{t("msg.no_result_channel")}")
-        content += f"\n\n{t("content.no_result_channel")},#genre#"
-        for i, name in enumerate(no_result_name):
-            end_char = ", " if i < len(no_result_name) - 1 else ""
-            custom_print(name, end=end_char)
-            content += f"\n{name},url"
-    if config.open_update_time:
-        update_time_item = next(
-            (urls[0] for channel_obj in data.values()
-             for info_list in channel_obj.values()
-             if (urls := _get_total_urls_cached(
-                info_list,
-                ipv_type_prefer,
-                origin_type_prefer,
-                rtmp_type,
-                apply_limit=True,
-            ))),
-            {"id": "id", "url": "url"}
-        )
-        now = get_datetime_now()
-        update_time_item_url = update_time_item["url"]
-        update_title = t("content.update_time") if is_last else t("content.update_running")
-        if open_url_info and update_time_item["extra_info"]:
-            update_time_item_url = add_url_info(update_time_item_url, update_time_item["extra_info"])
-        value = f"{hls_url}/{update_time_item["id"]}.m3u8" if hls_url else update_time_item_url
-        if config.update_time_position == "top":
-            content = f"{update_title},#genre#\n{now},{value}\n\n{content}"
-        else:
-            content += f"\n\n{update_title},#genre#\n{now},{value}"
-    if hls_url:
-        db_dir = os.path.dirname(constants.rtmp_data_path)
-        if db_dir:
-            os.makedirs(db_dir, exist_ok=True)
-
-        try:
-            ensure_result_data_schema(constants.rtmp_data_path)
-            conn = get_db_connection(constants.rtmp_data_path)
-        except Exception as e:
-            print(t("msg.write_error").format(info=f"open rtmp db error: {e}"))
-        else:
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "CREATE TABLE IF NOT EXISTS result_data (id TEXT PRIMARY KEY, url TEXT, headers TEXT, video_codec TEXT, audio_codec TEXT, resolution TEXT, fps REAL)"
-                )
-                for data_list in result_data.values():
-                    for item in data_list:
-                        cursor.execute(
-                            "INSERT OR REPLACE INTO result_data (id, url, headers, video_codec, audio_codec, resolution, fps) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            (
-                                str(item.get("id")),
-                                item.get("url"),
-                                json.dumps(item.get("headers", None)),
-                                item.get("video_codec"),
-                                item.get("audio_codec"),
-                                item.get("resolution"),
-                                item.get("fps"),
+    emitter = M3UEmitter()
+    update_time = (
+        t("content.update_time") if is_last else t("content.update_running"),
+        get_datetime_now(),
+    ) if config.open_update_time else None
+    update_time_top = config.update_time_position == "top"
+    writers = []
+    try:
+        for file in file_list:
+            writers.append(ResultFileWriter(
+                file["path"],
+                emitter,
+                hls_url=file.get("hls_url"),
+                ipv_type_prefer=file["ipv_type_prefer"],
+                origin_type_prefer=origin_type_prefer,
+                enable_log=file.get("enable_log", False),
+                update_time_top=update_time_top,
+            ))
+        ipv_type_prefers = list(dict.fromkeys(writer.ipv_key for writer in writers))
+        rtmp_items = {}
+        for cate, channel_obj in data.items():
+            apply_limit = cate != unmatch_category
+            for writer in writers:
+                writer.write_category(cate)
+            for name, info_list in channel_obj.items():
+                channel_urls = None
+                for writer in writers:
+                    fragment = render_cache.get(cate, name, writer.variant) if render_cache else None
+                    if fragment is None:
+                        if channel_urls is None:
+                            channel_urls = _get_total_urls_cached(
+                                info_list or [],
+                                ipv_type_prefers,
+                                origin_type_prefer,
+                                apply_limit=apply_limit,
                             )
+                        fragment = _render_channel_fragment(
+                            cate, name, channel_urls[writer.ipv_key], writer.hls_url, open_url_info, emitter
                         )
-                conn.commit()
-            finally:
-                return_db_connection(constants.rtmp_data_path, conn)
-    try:
-        target_dir = os.path.dirname(path) or "."
-        os.makedirs(target_dir, exist_ok=True)
-        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", delete=False, dir=target_dir,
-                                         prefix=os.path.basename(path) + ".tmp.") as tmpf:
-            tmpf.write(content)
-            tmp_path = tmpf.name
-        os.replace(tmp_path, path)
-        try:
-            os.chmod(path, 0o644)
-        except Exception:
-            pass
+                        if render_cache:
+                            render_cache.set(cate, name, writer.variant, fragment)
+                    writer.write_channel(name, *fragment, open_empty_category=open_empty_category)
+                    if writer.hls_url:
+                        for item in fragment[2]:
+                            rtmp_items[str(item.get("id"))] = item
+        for writer in writers:
+            writer.close(is_last, open_empty_category, update_time, open_url_info, first_channel_name)
     except Exception:
-        try:
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(content)
-        except Exception as e:
-            print(t("msg.write_error").format(info=e), flush=True)
-            return
-    try:
-        convert_to_m3u(path, first_channel_name, data=result_data)
-    except Exception as e:
-        print(t("msg.write_error").format(info=f"convert m3u error: {e}"), flush=True)
+        for writer in writers:
+            writer.abort()
+        raise
+    if any(writer.hls_url for writer in writers):
+        return _write_rtmp_result_data(rtmp_items.values())
+    return None
 
 
-def write_channel_to_file(data, ipv6=False, first_channel_name=None, skip_print=False, is_last=False):
+def write_channel_to_file(data, ipv6=False, first_channel_name=None, skip_print=False, is_last=False,
+                          render_cache: RenderCache = None, dirty=None):
     """
     Write channel to file
+    :param render_cache: the cache of the rendered channel fragments, reused between the writes
+    :param dirty: the (category, channel) pairs changed since the last write, all of them when None
+    :return: the number of the upserted and the deleted rows of the rtmp database, None when not written
     """
     try:
+        if render_cache:
+            render_cache.invalidate(dirty)
         if not skip_print:
             print(t("msg.writing_result"), flush=True)
         open_empty_category = config.open_empty_category
@@ -1122,13 +1435,13 @@ def write_channel_to_file(data, ipv6=False, first_channel_name=None, skip_print=
         origin_type_prefer = config.origin_type_prefer
         hls_url = f"{get_public_url()}/hls"
         file_list = [
-            {"path": config.final_file, "enable_log": True},
+            {"path": config.final_file, "ipv_type_prefer": ipv_type_prefer, "enable_log": True},
             {"path": constants.ipv4_result_path, "ipv_type_prefer": ["ipv4"]},
             {"path": constants.ipv6_result_path, "ipv_type_prefer": ["ipv6"]}
         ]
         if config.open_rtmp and not os.getenv("GITHUB_ACTIONS"):
             file_list += [
-                {"path": constants.hls_result_path, "hls_url": hls_url},
+                {"path": constants.hls_result_path, "hls_url": hls_url, "ipv_type_prefer": ipv_type_prefer},
                 {
                     "path": constants.hls_ipv4_result_path,
                     "hls_url": hls_url,
@@ -1140,22 +1453,17 @@ def write_channel_to_file(data, ipv6=False, first_channel_name=None, skip_print=
                     "ipv_type_prefer": ["ipv6"]
                 },
             ]
-        for file in file_list:
-            target_dir = os.path.dirname(file["path"])
-            if target_dir:
-                os.makedirs(target_dir, exist_ok=True)
-            process_write_content(
-                path=file["path"],
-                data=data,
-                hls_url=file.get("hls_url"),
-                open_empty_category=open_empty_category,
-                ipv_type_prefer=file.get("ipv_type_prefer", ipv_type_prefer),
-                origin_type_prefer=origin_type_prefer,
-                first_channel_name=first_channel_name,
-                enable_log=file.get("enable_log", False),
-                is_last=is_last
-            )
+        rtmp_rows = process_write_files(
+            data,
+            file_list,
+            open_empty_category=open_empty_category,
+            origin_type_prefer=origin_type_prefer,
+            first_channel_name=first_channel_name,
+            is_last=is_last,
+            render_cache=render_cache,
+        )
         if not skip_print:
             print(t("msg.write_success"), flush=True)
+        return rtmp_rows
     except Exception as e:
         print(t("msg.write_error").format(info=e), flush=True)
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter whose window follows an AIMD policy: it grows by one while
+    probes stay healthy and shrinks multiplicatively when the observed delay climbs
+    above its baseline, the failure rate rises or the local machine is under pressure.
+    """
+
+    def __init__(
+            self,
+            initial: int,
+            min_limit: int = 1,
+            max_limit: int = 50,
+            decrease_factor: float = 0.75,
+            delay_tolerance: float = 2.0,
+            failure_tolerance: float = 0.2,
+            load_threshold: float = 1.5,
+            fd_threshold: float = 0.8,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.decrease_factor = decrease_factor
+        self.delay_tolerance = delay_tolerance
+        self.failure_tolerance = failure_tolerance
+        self.load_threshold = load_threshold
+        self.fd_threshold = fd_threshold
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._delays: list[float] = []
+        self._failures = 0
+        self._samples = 0
+        self._saturated = False
+        self._base_delay: Optional[float] = None
+        self._base_failure_rate: Optional[float] = None
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    async def acquire(self) -> None:
+        """
+        Wait until the number of in-flight probes is below the current window
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._saturated = True
+
+    async def release(self) -> None:
+        """
+        Release a slot and wake up the waiters, the slot is given back before anything is awaited
+        so that a cancellation of the releasing task cannot leak it
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        await asyncio.shield(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+    def record(self, delay: Optional[float], failed: bool = False) -> None:
+        """
+        Record the outcome of a probe and adjust the window once enough samples were seen
+        """
+        self._samples += 1
+        if failed:
+            self._failures += 1
+        elif delay is not None and delay >= 0:
+            self._delays.append(delay)
+        if self._samples >= self.limit:
+            self._adjust()
+
+    def _adjust(self) -> None:
+        failure_rate = self._failures / self._samples
+        avg_delay = sum(self._delays) / len(self._delays) if self._delays else None
+        if self._base_failure_rate is None or failure_rate < self._base_failure_rate:
+            self._base_failure_rate = failure_rate
+        if avg_delay is not None and (self._base_delay is None or avg_delay < self._base_delay):
+            self._base_delay = avg_delay
+
+        congested = (
+                failure_rate > self._base_failure_rate + self.failure_tolerance
+                or (avg_delay is not None and avg_delay > self._base_delay * self.delay_tolerance)
+                or self._under_pressure()
+        )
+        if congested:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        elif self._saturated:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        # Let the baselines drift up slowly so they can follow the upstream conditions
+        self._base_failure_rate = min(1.0, self._base_failure_rate + 0.01)
+        if self._base_delay is not None:
+            self._base_delay *= 1.05
+        self._delays.clear()
+        self._failures = 0
+        self._samples = 0
+        self._saturated = False
+
+    def _under_pressure(self) -> bool:
+        """
+        Check the local CPU load and the usage of file descriptors
+        """
+        try:
+            if os.getloadavg()[0] / (os.cpu_count() or 1) > self.load_threshold:
+                return True
+        except (AttributeError, OSError):
+            pass
+        if resource:
+            try:
+                soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+                if 0 < soft_limit != resource.RLIM_INFINITY:
+                    if len(os.listdir("/proc/self/fd")) > soft_limit * self.fd_threshold:
+                        return True
+            except (OSError, ValueError):
+                pass
+        return False
+
+
+class TokenBucket:
+    """
+    Token bucket shared by the coroutines of a process, limiting the rate in units (bytes) per second.
+    A consumer that exceeds the available tokens goes into debt and sleeps until it is paid back,
+    so the long-run rate stays at the configured one without any lock.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self._last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def consume(self, amount: float) -> float:
+        """
+        Take amount tokens, waiting when there are not enough of them, and return the seconds waited
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        start = time.monotonic()
+        await asyncio.sleep(wait)
+        return time.monotonic() - start
+
+
+class CoalescingWriter:
+    """
+    Dedicated thread running the submitted writes one at a time. At most one write waits behind the running
+    one: a newer submission replaces it (the latest snapshot wins), with its arguments combined with the
+    replaced ones by the merge function, and the futures of both are resolved by the same write.
+    """
+
+    def __init__(self, write: Callable, merge: Optional[Callable[[tuple, tuple], tuple]] = None,
+                 name: str = "writer"):
+        self._write = write
+        self._merge = merge
+        self._name = name
+        self._condition = threading.Condition()
+        self._pending: Optional[tuple[tuple, list[Future]]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.writes = 0
+        self.coalesced = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+
+    def submit(self, *args) -> Future:
+        """
+        Submit a write, replacing the one waiting if any, and return the future of its result
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f"{self._name} is closed")
+            if self._pending is not None:
+                pending_args, futures = self._pending
+                futures.append(future)
+                self._pending = (self._merge(pending_args, args) if self._merge else args, futures)
+                self.coalesced += 1
+            else:
+                self._pending = (args, [future])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or self._closed)
+                if self._pending is None:
+                    return
+                args, futures = self._pending
+                self._pending = None
+            start = time.perf_counter()
+            try:
+                result = self._write(*args)
+            except BaseException as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(result)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.writes += 1
+                self.write_time += elapsed
+                self.max_write_time = max(self.max_write_time, elapsed)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Finish the waiting write and stop the thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+__all__ = ["AdaptiveLimiter", "TokenBucket", "CoalescingWriter"]
@@ -233,6 +233,14 @@ class ConfigManager:
     def speed_test_filter_host(self):
         return self.config.getboolean("Settings", "speed_test_filter_host", fallback=False)
 
+    @property
+    def speed_test_cache_ttl(self):
+        return self.config.getfloat("Settings", "speed_test_cache_ttl", fallback=0)
+
+    @property
+    def dns_cache_ttl(self):
+        return self.config.getfloat("Settings", "dns_cache_ttl", fallback=0)
+
     @property
     def cdn_url(self):
         return self.config.get("Settings", "cdn_url", fallback="")
@@ -253,6 +261,42 @@ class ConfigManager:
     def speed_test_limit(self):
         return self.config.getint("Settings", "speed_test_limit", fallback=5)
 
+    @property
+    def speed_test_host_limit(self):
+        return self.config.getint("Settings", "speed_test_host_limit", fallback=0)
+
+    @property
+    def speed_test_max_bandwidth(self):
+        return self.config.getfloat("Settings", "speed_test_max_bandwidth", fallback=0)
+
+    @property
+    def speed_test_max_bytes(self):
+        return self.config.getfloat("Settings", "speed_test_max_bytes", fallback=0)
+
+    @property
+    def speed_test_process_num(self):
+        return self.config.getint("Settings", "speed_test_process_num", fallback=1)
+
+    @property
+    def speed_test_ffmpeg_limit(self):
+        return self.config.getint("Settings", "speed_test_ffmpeg_limit", fallback=0)
+
+    @property
+    def open_speed_test_priority(self):
+        return self.config.getboolean("Settings", "open_speed_test_priority", fallback=False)
+
+    @property
+    def open_speed_test_adaptive(self):
+        return self.config.getboolean("Settings", "open_speed_test_adaptive", fallback=False)
+
+    @property
+    def speed_test_min_limit(self):
+        return self.config.getint("Settings", "speed_test_min_limit", fallback=2)
+
+    @property
+    def speed_test_max_limit(self):
+        return self.config.getint("Settings", "speed_test_max_limit", fallback=50)
+
     @property
     def location(self):
         return [
@@ -377,6 +421,20 @@ class ConfigManager:
                     pass
         return mapping
 
+    @property
+    def speed_test_segment_budget(self):
+        mapping = {}
+        for item in self.config.get("Settings", "speed_test_segment_budget", fallback="").split(","):
+            if ":" in item:
+                resolution_part, budget_part = item.split(":", 1)
+                resolution = resolution_part.strip()
+                try:
+                    budget = float(budget_part.strip())
+                    mapping[resolution] = budget
+                except ValueError:
+                    pass
+        return mapping
+
     @property
     def open_unmatch_category(self):
         return self.config.getboolean("Settings", "open_unmatch_category", fallback=False)
@@ -43,8 +43,14 @@ hls_ipv6_result_path = os.path.join(output_dir, "ipv6/hls.txt")
 
 cache_path = os.path.join(output_dir, "data/cache.gz")
 
+history_path = os.path.join(output_dir, "data/history.db")
+
 frozen_path = os.path.join(output_dir, "data/frozen.gz")
 
+speed_store_path = os.path.join(output_dir, "data/speed.db")
+
+dns_cache_path = os.path.join(output_dir, "data/dns.gz")
+
 speed_test_log_path = os.path.join(output_dir, "log/speed_test.log")
 
 result_log_path = os.path.join(output_dir, "log/result.log")
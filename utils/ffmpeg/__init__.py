@@ -1,4 +1,5 @@
 from .ffmpeg import ffmpeg_url, check_ffmpeg_installed_status
+from .pool import stats as subprocess_stats, reset_stats as reset_subprocess_stats
 from .probe import probe_url, get_resolution_ffprobe, probe_url_sync
 
 __all__ = [
@@ -7,4 +8,6 @@ __all__ = [
     "probe_url_sync",
     "check_ffmpeg_installed_status",
     "probe_url",
+    "subprocess_stats",
+    "reset_subprocess_stats",
 ]
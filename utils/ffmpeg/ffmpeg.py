@@ -3,6 +3,7 @@ import re
 import subprocess
 from time import time
 
+from utils.ffmpeg.pool import subprocess_slot
 from utils.i18n import t
 
 min_measure_time = 1.0
@@ -32,10 +33,21 @@ def check_ffmpeg_installed_status():
         return status
 
 
-async def ffmpeg_url(url, headers=None, timeout=10):
+async def ffmpeg_url(url, headers=None, timeout=10, return_elapsed=False):
     """
     Async wrapper that runs ffmpeg similar to old implementation and returns stderr output as text.
+    The process holds a slot of the subprocess pool while it runs.
+    With return_elapsed, the seconds spent since the slot was acquired are returned with the output,
+    so the time queued behind other processes is left out of the measurement.
     """
+    async with subprocess_slot("ffmpeg"):
+        start = time()
+        output = await _ffmpeg_url(url, headers, timeout)
+        elapsed = time() - start
+    return (output, elapsed) if return_elapsed else output
+
+
+async def _ffmpeg_url(url, headers=None, timeout=10):
     headers_str = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
 
     args = ["ffmpeg", "-t", str(timeout)]
@@ -0,0 +1,52 @@
+import asyncio
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+from time import time
+
+from utils.config import config
+
+stats: Counter = Counter()
+
+_semaphore: asyncio.Semaphore | None = None
+_semaphore_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_process_limit() -> int:
+    """
+    Get the maximum number of ffmpeg/ffprobe processes running at the same time, CPU count by default
+    """
+    limit = config.speed_test_ffmpeg_limit
+    if limit > 0:
+        return limit
+    return os.cpu_count() or 1
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore, _semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _semaphore is None or _semaphore_loop is not loop:
+        _semaphore = asyncio.Semaphore(get_process_limit())
+        _semaphore_loop = loop
+    return _semaphore
+
+
+@asynccontextmanager
+async def subprocess_slot(name: str):
+    """
+    Hold one of the subprocess slots while the process runs, and record its spawn count and run time
+    """
+    async with _get_semaphore():
+        start = time()
+        stats[f"{name}_spawns"] += 1
+        try:
+            yield
+        finally:
+            stats["subprocess_time"] += time() - start
+
+
+def reset_stats() -> None:
+    stats.clear()
+
+
+__all__ = ["stats", "get_process_limit", "subprocess_slot", "reset_stats"]
@@ -2,6 +2,8 @@ import asyncio
 import json
 import subprocess
 
+from utils.ffmpeg.pool import subprocess_slot
+
 
 def _parse_probe_data(data: dict) -> dict | None:
     """
@@ -63,6 +65,11 @@ async def probe_url(url: str, headers: dict = None, timeout: int = 10) -> dict |
     Use ffprobe to get metadata for the first video and audio streams.
     Returns a dict with keys: video_codec, audio_codec, resolution, fps
     """
+    async with subprocess_slot("ffprobe"):
+        return await _probe_url(url, headers, timeout)
+
+
+async def _probe_url(url: str, headers: dict = None, timeout: int = 10) -> dict | None:
     proc = None
     try:
         header_str = ''.join(f'{k}: {v}\r\n' for k, v in (headers or {}).items()) if headers else ''
@@ -186,6 +193,11 @@ async def get_resolution_ffprobe(url: str, headers: dict = None, timeout: int =
     """
     Use ffprobe to get width and height of the first video stream and return as 'WIDTHxHEIGHT', or None if not found.
     """
+    async with subprocess_slot("ffprobe"):
+        return await _get_resolution_ffprobe(url, headers, timeout)
+
+
+async def _get_resolution_ffprobe(url: str, headers: dict = None, timeout: int = 10) -> str | None:
     proc = None
     try:
         header_str = ''.join(f'{k}: {v}\r\n' for k, v in (headers or {}).items()) if headers else ''
@@ -1,98 +1,329 @@
 import gzip
+import heapq
 import os
 import pickle
+import threading
 import time
-from typing import Dict, Optional, Set
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 MAX_BACKOFF = 24 * 3600
 BASE_BACKOFF = 60
+MAX_ENTRIES = 200000
+EVICT_RATIO = 0.1
+JOURNAL_BATCH_SIZE = 1000
+JOURNAL_COMPACT_RECORDS = 50000
 
-_frozen: Dict[str, Dict] = {}
+
+class FrozenEntry:
+    """
+    The frozen state of a url
+    """
+    __slots__ = ("bad_count", "last_bad", "last_good", "frozen_until")
+
+    def __init__(self, bad_count: int = 0, last_bad: int = 0, last_good: int = 0, frozen_until: Optional[int] = None):
+        self.bad_count = bad_count
+        self.last_bad = last_bad
+        self.last_good = last_good
+        self.frozen_until = frozen_until
+
+    @classmethod
+    def from_value(cls, value) -> Optional["FrozenEntry"]:
+        """
+        Build the entry from its tuple, or from the dict of the former format
+        """
+        if isinstance(value, dict):
+            return cls(value.get("bad_count", 0), value.get("last_bad", 0), value.get("last_good", 0),
+                       value.get("frozen_until"))
+        if isinstance(value, (tuple, list)) and len(value) == 4:
+            return cls(*value)
+        return None
+
+    def to_tuple(self) -> Tuple:
+        return self.bad_count, self.last_bad, self.last_good, self.frozen_until
+
+    def to_dict(self) -> Dict:
+        return {"bad_count": self.bad_count, "last_bad": self.last_bad, "last_good": self.last_good,
+                "frozen_until": self.frozen_until}
+
+
+_frozen: Dict[str, FrozenEntry] = {}
+_expiry: List[Tuple[int, str]] = []
+_lock = threading.Lock()
+_io_lock = threading.Lock()
+_journal_pending: List[Tuple[str, Optional[Tuple]]] = []
+_journal_records = 0
+_snapshot_path: Optional[str] = None
 
 
 def _now_ts() -> int:
     return int(time.time())
 
 
+def _journal_path(path: str) -> str:
+    return path + ".journal"
+
+
+def _record(url: str) -> None:
+    """
+    Record the current state of the url in the pending journal batch, called with the lock held
+    """
+    if _snapshot_path:
+        entry = _frozen.get(url)
+        _journal_pending.append((url, entry.to_tuple() if entry else None))
+
+
+def _flush_if_full() -> None:
+    if len(_journal_pending) >= JOURNAL_BATCH_SIZE:
+        flush_journal()
+
+
+def _set_entry(url: str, entry: FrozenEntry) -> None:
+    """
+    Set the entry of the url and index its expiry, called with the lock held
+    """
+    _frozen[url] = entry
+    if entry.frozen_until:
+        heapq.heappush(_expiry, (entry.frozen_until, url))
+        if len(_expiry) > max(1024, 2 * len(_frozen)):
+            _expiry[:] = [(entry.frozen_until, url) for url, entry in _frozen.items() if entry.frozen_until]
+            heapq.heapify(_expiry)
+
+
+def _expire(now: int) -> None:
+    """
+    Thaw the entries whose freeze is over, in the order of the expiry heap, called with the lock held:
+    a heap item left behind by a later change of its entry is skipped
+    """
+    while _expiry and _expiry[0][0] <= now:
+        frozen_until, url = heapq.heappop(_expiry)
+        entry = _frozen.get(url)
+        if not entry or entry.frozen_until != frozen_until:
+            continue
+        entry.frozen_until = None
+        entry.bad_count = max(0, entry.bad_count - 1)
+        if entry.bad_count == 0:
+            _frozen.pop(url, None)
+        _record(url)
+
+
+def _has_expired(now: int) -> bool:
+    return bool(_expiry) and _expiry[0][0] <= now
+
+
+def _evict() -> None:
+    """
+    Evict the oldest never recovered entries once the registry exceeds its cap, called with the lock held
+    """
+    if len(_frozen) <= MAX_ENTRIES:
+        return
+    count = len(_frozen) - int(MAX_ENTRIES * (1 - EVICT_RATIO))
+    for url, _ in heapq.nsmallest(count, _frozen.items(), key=lambda item: (item[1].last_good > 0, item[1].last_bad)):
+        _frozen.pop(url, None)
+        _record(url)
+
+
 def mark_url_bad(url: str, initial: bool = False) -> None:
     if not url:
         return
-    meta = _frozen.setdefault(url, {"bad_count": 0, "last_bad": 0, "last_good": 0, "frozen_until": None})
-    if initial:
-        meta["bad_count"] = max(meta["bad_count"], 3)
-    meta["bad_count"] += 1
-    meta["last_bad"] = _now_ts()
-    backoff = min(MAX_BACKOFF, (2 ** meta["bad_count"]) * BASE_BACKOFF)
-    meta["frozen_until"] = _now_ts() + backoff
+    with _lock:
+        entry = _frozen.get(url)
+        is_new = entry is None
+        if is_new:
+            entry = FrozenEntry()
+        if initial:
+            entry.bad_count = max(entry.bad_count, 3)
+        entry.bad_count += 1
+        entry.last_bad = _now_ts()
+        backoff = min(MAX_BACKOFF, (2 ** entry.bad_count) * BASE_BACKOFF)
+        entry.frozen_until = _now_ts() + backoff
+        _set_entry(url, entry)
+        _record(url)
+        if is_new:
+            _evict()
+    _flush_if_full()
 
 
 def mark_url_good(url: str) -> None:
     if not url:
         return
-    meta = _frozen.get(url)
-    if not meta:
-        return
-    meta["last_good"] = _now_ts()
-    meta["bad_count"] = max(0, meta.get("bad_count", 0) - 1)
-    meta["frozen_until"] = None
-    if meta["bad_count"] == 0:
-        _frozen.pop(url, None)
+    with _lock:
+        entry = _frozen.get(url)
+        if not entry:
+            return
+        entry.last_good = _now_ts()
+        entry.bad_count = max(0, entry.bad_count - 1)
+        entry.frozen_until = None
+        if entry.bad_count == 0:
+            _frozen.pop(url, None)
+        _record(url)
+    _flush_if_full()
 
 
 def is_url_frozen(url: str) -> bool:
-    meta = _frozen.get(url)
-    if not meta:
-        return False
-    fu = meta.get("frozen_until")
-    if not fu:
-        return False
     now = _now_ts()
-    if fu > now:
-        return True
-    meta["frozen_until"] = None
-    meta["bad_count"] = max(0, meta.get("bad_count", 0) - 1)
-    if meta["bad_count"] == 0:
-        _frozen.pop(url, None)
-    return False
+    if _has_expired(now):
+        with _lock:
+            _expire(now)
+        _flush_if_full()
+    entry = _frozen.get(url)
+    return bool(entry and entry.frozen_until)
+
+
+def filter_frozen(urls: Iterable[str]) -> Set[str]:
+    """
+    Get the frozen urls among the urls, with one expiry pass for all of them
+    """
+    now = _now_ts()
+    if _has_expired(now):
+        with _lock:
+            _expire(now)
+        _flush_if_full()
+    if not _frozen:
+        return set()
+    return {url for url in urls if (entry := _frozen.get(url)) and entry.frozen_until}
+
+
+def get_url_bad_count(url: str) -> int:
+    entry = _frozen.get(url)
+    if not entry:
+        return 0
+    return entry.bad_count
 
 
 def get_current_frozen_set() -> Set[str]:
     now = _now_ts()
-    res = set()
-    for url, meta in list(_frozen.items()):
-        fu = meta.get("frozen_until")
-        if fu and fu > now:
-            res.add(url)
-        else:
-            is_url_frozen(url)
+    with _lock:
+        _expire(now)
+        res = {url for frozen_until, url in _expiry if
+               (entry := _frozen.get(url)) and entry.frozen_until == frozen_until}
+    _flush_if_full()
     return res
 
 
-def load(path: Optional[str]) -> None:
-    if not path or not os.path.exists(path):
-        return
+def get_entries(urls) -> Dict[str, Optional[Dict]]:
+    return {url: (entry.to_dict() if (entry := _frozen.get(url)) else None) for url in urls if url}
+
+
+def update_entries(entries: Dict[str, Optional[Dict]]) -> None:
+    with _lock:
+        for url, meta in entries.items():
+            entry = FrozenEntry.from_value(meta) if meta else None
+            if entry:
+                _set_entry(url, entry)
+            else:
+                _frozen.pop(url, None)
+            _record(url)
+        _evict()
+    _flush_if_full()
+
+
+def _replay_journal(path: str) -> Dict[str, Optional[Tuple]]:
+    """
+    Read the batches of the journal in order, a batch cut short by a crash ends the replay
+    """
+    entries = {}
+    records = 0
     try:
-        with gzip.open(path, "rb") as f:
-            data = pickle.load(f)
-            if isinstance(data, dict):
-                for k, v in data.items():
-                    if k not in _frozen:
-                        _frozen[k] = v
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    break
+                for url, value in batch:
+                    entries[url] = value
+                records += len(batch)
     except Exception:
         pass
+    global _journal_records
+    _journal_records = records
+    return entries
+
+
+def load(path: Optional[str]) -> None:
+    """
+    Load the snapshot and replay the journal written since, the later changes are journaled
+    until the next save
+    """
+    global _snapshot_path
+    if not path:
+        return
+    data = {}
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            pass
+    if not isinstance(data, dict):
+        data = {}
+    for url, value in _replay_journal(_journal_path(path)).items():
+        if value:
+            data[url] = value
+        else:
+            data.pop(url, None)
+    with _lock:
+        for url, value in data.items():
+            if url not in _frozen and (entry := FrozenEntry.from_value(value)):
+                _set_entry(url, entry)
+        _evict()
+        _snapshot_path = path
+
+
+def flush_journal() -> None:
+    """
+    Append the pending changes to the journal as one fsynced batch, the journal is compacted
+    into the snapshot once it holds too many records
+    """
+    global _journal_records
+    if not _snapshot_path:
+        return
+    with _io_lock:
+        with _lock:
+            batch = _journal_pending[:]
+            _journal_pending.clear()
+        if not batch:
+            return
+        try:
+            with open(_journal_path(_snapshot_path), "ab") as f:
+                pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            _journal_records += len(batch)
+        except Exception:
+            pass
+        compact = _journal_records >= JOURNAL_COMPACT_RECORDS
+    if compact:
+        save(_snapshot_path)
 
 
 def save(path: Optional[str]) -> None:
+    """
+    Write the snapshot atomically and truncate the journal it replaces
+    """
+    global _journal_records
     if not path:
         return
-    try:
-        dirp = os.path.dirname(path)
-        if dirp:
-            os.makedirs(dirp, exist_ok=True)
-        with gzip.open(path, "wb") as f:
-            pickle.dump(_frozen, f)
-    except Exception:
-        pass
+    with _io_lock:
+        try:
+            dirp = os.path.dirname(path)
+            if dirp:
+                os.makedirs(dirp, exist_ok=True)
+            with _lock:
+                data = pickle.dumps({url: entry.to_tuple() for url, entry in _frozen.items()},
+                                    protocol=pickle.HIGHEST_PROTOCOL)
+                _journal_pending.clear()
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            journal_path = _journal_path(path)
+            if os.path.exists(journal_path):
+                os.truncate(journal_path, 0)
+            _journal_records = 0
+        except Exception:
+            pass
 
 
-__all__ = ["mark_url_bad", "mark_url_good", "is_url_frozen", "get_current_frozen_set", "load", "save"]
+__all__ = ["FrozenEntry", "mark_url_bad", "mark_url_good", "is_url_frozen", "filter_frozen", "get_url_bad_count",
+           "get_current_frozen_set", "get_entries", "update_entries", "load", "flush_journal", "save"]
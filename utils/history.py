@@ -0,0 +1,207 @@
+import gzip
+import os
+import pickle
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from utils.db import get_db_connection, return_db_connection
+from utils.i18n import t
+from utils.types import CategoryChannelData
+
+QUERY_CHUNK_SIZE = 500
+COMPACT_FREE_RATIO = 0.25
+
+_result: CategoryChannelData = {}
+_row_hashes: Dict[tuple, int] = {}
+
+
+def _ensure_schema(conn) -> None:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS history (cate TEXT NOT NULL, name TEXT NOT NULL, key TEXT NOT NULL, items BLOB NOT NULL, PRIMARY KEY (cate, name))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS history_key ON history (key)")
+
+
+def _add_row(cate: str, name: str, blob: bytes) -> None:
+    _result.setdefault(cate, {})[name] = pickle.loads(blob)
+    _row_hashes[(cate, name)] = hash(blob)
+
+
+def migrate(path: Optional[str], legacy_path: Optional[str], key_func: Callable[[str], str]) -> None:
+    """
+    Import the legacy gzip pickle cache into the store once, the legacy file is kept with a .bak suffix
+    once its rows are committed, otherwise it is left in place for the next run to retry
+    """
+    if not path or not legacy_path or not os.path.exists(legacy_path):
+        return
+    try:
+        with gzip.open(legacy_path, "rb") as f:
+            legacy = pickle.load(f) or {}
+        if save(path, legacy, key_func):
+            os.replace(legacy_path, legacy_path + ".bak")
+    except Exception as e:
+        print(t("msg.error_load_cache").format(info=e))
+    _result.clear()
+    _row_hashes.clear()
+
+
+def load(path: Optional[str], keys: Optional[Iterable[str]] = None) -> CategoryChannelData:
+    """
+    Load the history of the channels whose normalized name is in keys, or of all channels when keys is None
+    """
+    _result.clear()
+    _row_hashes.clear()
+    if not path or not os.path.exists(path):
+        return _result
+    conn = None
+    try:
+        conn = get_db_connection(path)
+        _ensure_schema(conn)
+        if keys is None:
+            for cate, name, blob in conn.execute("SELECT cate, name, items FROM history ORDER BY rowid"):
+                _add_row(cate, name, blob)
+        else:
+            keys = list(dict.fromkeys(keys))
+            for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+                chunk = keys[i:i + QUERY_CHUNK_SIZE]
+                rows = conn.execute(
+                    f"SELECT cate, name, items FROM history WHERE key IN ({', '.join('?' * len(chunk))}) ORDER BY rowid",
+                    chunk
+                )
+                for cate, name, blob in rows:
+                    _add_row(cate, name, blob)
+    except Exception as e:
+        print(t("msg.error_load_cache").format(info=e))
+    finally:
+        if conn:
+            return_db_connection(path, conn)
+    return _result
+
+
+def get_result() -> CategoryChannelData:
+    """
+    Get the loaded history
+    """
+    return _result
+
+
+def clear() -> None:
+    """
+    Release the loaded history
+    """
+    _result.clear()
+
+
+def serialize(
+        result: CategoryChannelData,
+        channels: Optional[Iterable[Tuple[str, str]]] = None
+) -> Dict[Tuple[str, str], bytes]:
+    """
+    Serialize the items of the channels of the result, or of all its channels when channels is None.
+    Called where the result is owned, so that the rows can be written from another thread
+    """
+    if channels is None:
+        channels = ((cate, name) for cate, channel_obj in result.items() for name in channel_obj)
+    blobs = {}
+    for cate, name in channels:
+        info_list = result.get(cate, {}).get(name)
+        if info_list is not None:
+            blobs[(cate, name)] = pickle.dumps(list(info_list), protocol=pickle.HIGHEST_PROTOCOL)
+    return blobs
+
+
+def _get_changed_rows(blobs: Dict[Tuple[str, str], bytes], key_func: Callable[[str], str]) -> list:
+    """
+    Get the rows of the channels whose items changed since they were loaded or last written
+    """
+    return [
+        (cate, name, key_func(name), blob)
+        for (cate, name), blob in blobs.items()
+        if _row_hashes.get((cate, name)) != hash(blob)
+    ]
+
+
+def _write_rows(conn, rows: list) -> None:
+    conn.executemany("INSERT OR REPLACE INTO history (cate, name, key, items) VALUES (?, ?, ?, ?)", rows)
+    for cate, name, _, blob in rows:
+        _row_hashes[(cate, name)] = hash(blob)
+
+
+def update(path: Optional[str], blobs: Dict[Tuple[str, str], bytes], key_func: Callable[[str], str]) -> int:
+    """
+    Persist the changed channels serialized during the run, in one transaction appended to
+    the write-ahead log, the channels missing from the blobs are kept until the save
+    """
+    if not path:
+        return 0
+    conn = None
+    try:
+        dirp = os.path.dirname(path)
+        if dirp:
+            os.makedirs(dirp, exist_ok=True)
+        conn = get_db_connection(path)
+        _ensure_schema(conn)
+        rows = _get_changed_rows(blobs, key_func)
+        if rows:
+            with conn:
+                _write_rows(conn, rows)
+        return len(rows)
+    except Exception as e:
+        print(t("msg.error_save_cache").format(info=e))
+        return 0
+    finally:
+        if conn:
+            return_db_connection(path, conn)
+
+
+def save(path: Optional[str], result: CategoryChannelData, key_func: Callable[[str], str]) -> bool:
+    """
+    Replace the history with the result in one transaction: only the channels whose items changed since
+    they were loaded are written, and the channels missing from the result are deleted.
+    Return whether the transaction was committed
+    """
+    if not path:
+        return False
+    conn = None
+    try:
+        dirp = os.path.dirname(path)
+        if dirp:
+            os.makedirs(dirp, exist_ok=True)
+        conn = get_db_connection(path)
+        _ensure_schema(conn)
+        result = result or {}
+        rows = _get_changed_rows(serialize(result), key_func)
+        stale = [row for row in conn.execute("SELECT cate, name FROM history") if _is_stale(result, row)]
+        with conn:
+            if rows:
+                _write_rows(conn, rows)
+            if stale:
+                conn.executemany("DELETE FROM history WHERE cate = ? AND name = ?", stale)
+    except Exception as e:
+        print(t("msg.error_save_cache").format(info=e))
+        return False
+    finally:
+        if conn:
+            try:
+                _compact(conn)
+            except Exception:
+                pass
+            return_db_connection(path, conn)
+    return True
+
+
+def _is_stale(result: CategoryChannelData, row: Tuple[str, str]) -> bool:
+    return row[1] not in result.get(row[0], {})
+
+
+def _compact(conn) -> None:
+    """
+    Fold the write-ahead log into the database, which is rebuilt when the free pages exceed the ratio of its size
+    """
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if page_count and freelist_count / page_count > COMPACT_FREE_RATIO:
+        conn.execute("VACUUM")
+
+
+__all__ = ["migrate", "load", "get_result", "clear", "serialize", "update", "save"]
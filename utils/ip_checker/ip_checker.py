@@ -1,10 +1,23 @@
+import asyncio
+import gzip
+import ipaddress
+import os
+import pickle
 import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import ipdb
 
 from utils.tools import resource_path
 
+DNS_WORKERS = 32
+DNS_TIMEOUT = 5
+DNS_NEGATIVE_TTL = 600
+IP_MAP_CACHE_SIZE = 131072
+
 
 class IPChecker:
     def __init__(self):
@@ -12,6 +25,9 @@ class IPChecker:
         self.url_host = {}
         self.host_ip = {}
         self.host_ipv_type = {}
+        self.host_expires = {}
+        self.dns_ttl = 0
+        self.ip_map: OrderedDict[str, tuple[str | None, str | None]] = OrderedDict()
 
     def get_host(self, url: str) -> str:
         """
@@ -35,34 +51,159 @@ class IPChecker:
         self.get_ipv_type(url)
         return self.host_ip.get(host)
 
+    def _is_resolved(self, host: str) -> bool:
+        if host not in self.host_ipv_type:
+            return False
+        expires = self.host_expires.get(host)
+        return expires is None or expires > time.time()
+
+    def _set_resolution(self, host: str, addr_info: list | None) -> str:
+        if addr_info:
+            ip = next((info[4][0] for info in addr_info if info[0] == socket.AF_INET6), None)
+            if not ip:
+                ip = next((info[4][0] for info in addr_info if info[0] == socket.AF_INET), None)
+            ipv_type = "ipv6" if any(info[0] == socket.AF_INET6 for info in addr_info) else "ipv4"
+        else:
+            ip = None
+            ipv_type = "ipv4"
+        self.host_ip[host] = ip
+        self.host_ipv_type[host] = ipv_type
+        if ip:
+            self.host_expires[host] = time.time() + self.dns_ttl if self.dns_ttl > 0 else None
+        else:
+            self.host_expires[host] = time.time() + (min(self.dns_ttl, DNS_NEGATIVE_TTL) if self.dns_ttl > 0
+                                                     else DNS_NEGATIVE_TTL)
+        return ipv_type
+
     def get_ipv_type(self, url: str) -> str:
         """
         Get the IPv type of URL
         """
         host = self.get_host(url)
-        if host in self.host_ipv_type:
+        if self._is_resolved(host):
             return self.host_ipv_type[host]
 
         try:
             addr_info = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
-            ip = next((info[4][0] for info in addr_info if info[0] == socket.AF_INET6), None)
-            if not ip:
-                ip = next((info[4][0] for info in addr_info if info[0] == socket.AF_INET), None)
-            ipv_type = "ipv6" if any(info[0] == socket.AF_INET6 for info in addr_info) else "ipv4"
         except Exception:
-            ip = None
-            ipv_type = "ipv4"
+            addr_info = None
+        return self._set_resolution(host, addr_info)
 
-        self.host_ip[host] = ip
-        self.host_ipv_type[host] = ipv_type
-        return ipv_type
+    async def prefetch(self, urls, workers: int = DNS_WORKERS, timeout: float = DNS_TIMEOUT) -> None:
+        """
+        Resolve the hosts of the urls concurrently on a bounded thread pool, so the later lookups hit the cache.
+        Hosts failing or timing out are cached as unresolved for a short time.
+        """
+        hosts = set()
+        for url in urls:
+            host = self.get_host(url)
+            if not host or host in hosts or self._is_resolved(host):
+                continue
+            try:
+                ipaddress.ip_address(host.strip("[]"))
+            except ValueError:
+                hosts.add(host)
+        if not hosts:
+            return
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        async def resolve(host):
+            async with semaphore:
+                try:
+                    addr_info = await asyncio.wait_for(
+                        loop.run_in_executor(
+                            executor, socket.getaddrinfo, host, None, socket.AF_UNSPEC, socket.SOCK_STREAM
+                        ),
+                        timeout=timeout,
+                    )
+                except Exception:
+                    addr_info = None
+                self._set_resolution(host, addr_info)
+
+        try:
+            await asyncio.gather(*(resolve(host) for host in hosts))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def load_dns_cache(self, path: str, ttl: float) -> None:
+        """
+        Load the unexpired resolutions of the previous runs, resolutions are then kept for ttl seconds.
+        With a ttl of 0 nothing is cached across runs: the resolutions of the previous run are dropped
+        and the new ones are only kept for the current run
+        """
+        self.dns_ttl = ttl
+        if ttl <= 0:
+            self.host_ip.clear()
+            self.host_ipv_type.clear()
+            self.host_expires.clear()
+            return
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with gzip.open(path, "rb") as f:
+                data = pickle.load(f)
+            now = time.time()
+            for host, (ip, ipv_type, expires) in data.items():
+                if expires and expires > now and host not in self.host_ipv_type:
+                    self.host_ip[host] = ip
+                    self.host_ipv_type[host] = ipv_type
+                    self.host_expires[host] = expires
+        except Exception:
+            pass
+
+    def save_dns_cache(self, path: str) -> None:
+        """
+        Save the unexpired resolutions
+        """
+        if self.dns_ttl <= 0 or not path:
+            return
+        try:
+            now = time.time()
+            data = {
+                host: (self.host_ip.get(host), ipv_type, expires)
+                for host, ipv_type in self.host_ipv_type.items()
+                if (expires := self.host_expires.get(host)) and expires > now
+            }
+            dirp = os.path.dirname(path)
+            if dirp:
+                os.makedirs(dirp, exist_ok=True)
+            with gzip.open(path, "wb") as f:
+                pickle.dump(data, f)
+        except Exception:
+            pass
 
     def find_map(self, ip: str) -> tuple[str | None, str | None]:
         """
-        Find the IP address and return the location and ISP
+        Find the IP address and return the location and ISP, the results are kept in an LRU cache
         :param ip: The IP address to find
         :return: A tuple of (location, ISP)
         """
+        if ip in self.ip_map:
+            self.ip_map.move_to_end(ip)
+            return self.ip_map[ip]
+
+        result = self.lookup_map(ip)
+        self.ip_map[ip] = result
+        if len(self.ip_map) > IP_MAP_CACHE_SIZE:
+            self.ip_map.popitem(last=False)
+        return result
+
+    def prefetch_maps(self, urls) -> None:
+        """
+        Look up the location and ISP of every unique IP of the urls once, for the later find_map calls
+        """
+        ips = {ip for url in urls if (ip := self.get_ip(url))}
+        for ip in ips:
+            if ip not in self.ip_map:
+                self.find_map(ip)
+
+    def lookup_map(self, ip: str) -> tuple[str | None, str | None]:
+        """
+        Look up the location and ISP of the IP address in the database, without the cache
+        """
         try:
             result = self.db.find_map(ip, "CN")
             if not result:
@@ -1,6 +1,9 @@
 import asyncio
 import http.cookies
+import math
 import re
+from collections import Counter
+from contextlib import nullcontext
 from time import time
 from urllib.parse import quote, urljoin
 
@@ -8,8 +11,10 @@ import m3u8
 from aiohttp import ClientSession, TCPConnector
 
 import utils.constants as constants
+import utils.speed_store as speed_store
+from utils.concurrency import TokenBucket
 from utils.config import config
-from utils.ffmpeg import probe_url, ffmpeg_url
+from utils.ffmpeg import probe_url, ffmpeg_url, reset_subprocess_stats
 from utils.i18n import t
 from utils.requests.tools import headers as request_headers
 from utils.tools import get_resolution_value
@@ -17,7 +22,11 @@ from utils.types import TestResult, ChannelTestResult, TestResultCacheData
 
 http.cookies._is_legal_key = lambda _: True
 cache: TestResultCacheData = {}
+stats: Counter = Counter()
 speed_test_timeout = config.speed_test_timeout
+speed_test_cache_ttl = config.speed_test_cache_ttl * 3600
+# The samples are also kept for the prior score of the prioritised dispatch, without being reused
+store_samples = speed_test_cache_ttl > 0 or config.open_speed_test_priority
 speed_test_filter_host = config.speed_test_filter_host
 open_filter_resolution = config.open_filter_resolution
 min_resolution_value = config.min_resolution_value
@@ -40,11 +49,74 @@ min_measure_time = 1.0
 stability_window = 4
 stability_threshold = 0.12
 
+hls_bandwidth_pattern = re.compile(r'(?:^|,)BANDWIDTH=(\d+)')
+hls_resolution_pattern = re.compile(r'(?:^|,)RESOLUTION=(\d+x\d+)')
+
+segment_budget_map = sorted(
+    (get_resolution_value(resolution), int(budget * 1024 * 1024))
+    for resolution, budget in config.speed_test_segment_budget.items()
+    if get_resolution_value(resolution) and budget > 0
+)
+
+bandwidth_limiter: TokenBucket | None = None
+max_download_bytes = 0
+
+
+def set_download_limits(max_bandwidth: float = 0, max_bytes: float = 0) -> None:
+    """
+    Set the process-wide download rate limit (MB/s) and the download budget of a run (MB), 0 means unlimited
+    """
+    global bandwidth_limiter, max_download_bytes
+    bandwidth_limiter = TokenBucket(max_bandwidth * 1024 * 1024) if max_bandwidth > 0 else None
+    max_download_bytes = int(max_bytes * 1024 * 1024) if max_bytes > 0 else 0
+
+
+def is_download_budget_exhausted() -> bool:
+    return 0 < max_download_bytes <= stats["download_bytes"]
+
+
+set_download_limits(config.speed_test_max_bandwidth, config.speed_test_max_bytes)
+
+session_limit_per_host = 10
+session_dns_cache_ttl = 600
+session_keepalive_timeout = 30
+
+
+def create_speed_test_session(limit: int = 0, limit_per_host: int = session_limit_per_host) -> ClientSession:
+    """
+    Create a pooled session to be shared by all the requests of a speed test run,
+    so that connections, DNS lookups and TLS handshakes are reused across urls
+    """
+    connector = TCPConnector(
+        ssl=False,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=session_dns_cache_ttl,
+        keepalive_timeout=session_keepalive_timeout,
+    )
+    return ClientSession(connector=connector, trust_env=True)
+
+
+def get_segment_budget(resolution: str = None) -> int:
+    """
+    Get the byte budget of a sampled segment for the resolution class, 0 means no budget
+    """
+    if not segment_budget_map:
+        return 0
+    resolution_value = get_resolution_value(resolution) if resolution else 0
+    if resolution_value:
+        for class_value, budget in segment_budget_map:
+            if resolution_value <= class_value:
+                return budget
+    return segment_budget_map[-1][1]
+
 
 async def get_speed_with_download(url: str, headers: dict = None, session: ClientSession = None,
-                                  timeout: int = speed_test_timeout) -> dict[str, float | None]:
+                                  timeout: int = speed_test_timeout, byte_budget: int = 0) -> dict[str, float | None]:
     """
-    Get the speed of the url with a total timeout
+    Get the speed of the url with a total timeout, reading at most byte_budget bytes when it is set.
+    The time spent waiting for the bandwidth limiter is not counted in the speed.
     """
     start_time = time()
     delay = -1
@@ -52,6 +124,7 @@ async def get_speed_with_download(url: str, headers: dict = None, session: Clien
     min_bytes = 64 * 1024
     last_sample_time = start_time
     last_sample_size = 0
+    throttled_time = 0.0
 
     if session is None:
         session = ClientSession(connector=TCPConnector(ssl=False), trust_env=True)
@@ -61,14 +134,24 @@ async def get_speed_with_download(url: str, headers: dict = None, session: Clien
 
     speed_samples: list[float] = []
     try:
-        async with session.get(url, headers=headers, timeout=timeout) as response:
-            if response.status != 200:
+        range_headers = headers
+        if byte_budget > 0:
+            range_headers = {**(headers or {}), 'Range': f'bytes=0-{byte_budget - 1}'}
+        response = await session.get(url, headers=range_headers, timeout=timeout)
+        if response.status == 416 and byte_budget > 0:
+            response.release()
+            response = await session.get(url, headers=headers, timeout=timeout)
+        async with response:
+            if response.status not in (200, 206):
                 raise Exception("Invalid response")
             delay = int(round((time() - start_time) * 1000))
             async for chunk in response.content.iter_any():
                 if chunk:
                     total_size += len(chunk)
-                    now = time()
+                    stats["download_bytes"] += len(chunk)
+                    if bandwidth_limiter:
+                        throttled_time += await bandwidth_limiter.consume(len(chunk))
+                    now = time() - throttled_time
                     elapsed = now - start_time
                     delta_t = now - last_sample_time
                     delta_b = total_size - last_sample_size
@@ -77,6 +160,8 @@ async def get_speed_with_download(url: str, headers: dict = None, session: Clien
                         speed_samples.append(inst_speed)
                         last_sample_time = now
                         last_sample_size = total_size
+                    if 0 < byte_budget <= total_size or is_download_budget_exhausted():
+                        break
                     if (elapsed >= min_measure_time and total_size >= min_bytes
                             and len(speed_samples) >= stability_window):
                         window = speed_samples[-stability_window:]
@@ -92,7 +177,9 @@ async def get_speed_with_download(url: str, headers: dict = None, session: Clien
     except:
         pass
     finally:
-        total_time = time() - start_time
+        total_time = time() - start_time - throttled_time
+        if throttled_time:
+            stats["throttled_time"] += throttled_time
         if created_session:
             await session.close()
         speed_value = total_size / total_time / 1024 / 1024 if total_time > 0 else 0.0
@@ -180,36 +267,39 @@ def _parse_time_to_seconds(t: str) -> float:
 
 async def get_result(url: str, headers: dict = None, resolution: str = None,
                      filter_resolution: bool = config.open_filter_resolution,
-                     timeout: int = speed_test_timeout) -> dict[str, float | None]:
+                     timeout: int = speed_test_timeout, session: ClientSession = None) -> dict[str, float | None]:
     """
     Get the test result of the url
     """
     info = {'speed': 0.0, 'delay': -1, 'resolution': resolution}
     location = None
+    variant_resolution = None
+    stream_probed = False
     try:
         url = quote(url, safe=':/?$&=@[]%').partition('$')[0]
-        async with ClientSession(connector=TCPConnector(ssl=False), trust_env=True) as session:
+        async with (nullcontext(session) if session else
+                    ClientSession(connector=TCPConnector(ssl=False), trust_env=True)) as session:
             res_headers = await get_headers(url, headers, session)
             if not res_headers:
                 return info
             location = res_headers.get('Location')
             if location:
-                info.update(await get_result(location, headers, resolution, filter_resolution, timeout))
+                info.update(await get_result(location, headers, resolution, filter_resolution, timeout, session))
             else:
                 url_content = await get_url_content(url, headers, session, timeout)
                 if url_content:
-                    m3u8_obj = m3u8.loads(url_content)
-                    playlists = m3u8_obj.playlists
-                    segments = m3u8_obj.segments
-                    if playlists:
-                        best_playlist = max(m3u8_obj.playlists, key=lambda p: p.stream_info.bandwidth)
-                        playlist_url = urljoin(url, best_playlist.uri)
+                    playlist = parse_playlist(url_content, speed_test_limit)
+                    if playlist['variants']:
+                        best_variant = max(playlist['variants'], key=lambda variant: variant['bandwidth'])
+                        variant_resolution = best_variant['resolution']
+                        playlist_url = urljoin(url, best_variant['uri'])
                         playlist_content = await get_url_content(playlist_url, headers, session, timeout)
                         if playlist_content:
-                            media_playlist = m3u8.loads(playlist_content)
-                            segment_urls = [urljoin(playlist_url, segment.uri) for segment in media_playlist.segments]
+                            media_playlist = parse_playlist(playlist_content, speed_test_limit)
+                            segment_urls = [urljoin(playlist_url, segment['uri']) for segment in
+                                            media_playlist['segments']]
                     else:
-                        segment_urls = [urljoin(url, segment.uri) for segment in segments]
+                        segment_urls = [urljoin(url, segment['uri']) for segment in playlist['segments']]
                     if not segment_urls:
                         raise Exception("Segment urls not found")
                 else:
@@ -217,7 +307,9 @@ async def get_result(url: str, headers: dict = None, resolution: str = None,
                     info.update({'speed': res_info['speed'], 'delay': res_info['delay']})
                 start_time = time()
                 sampled_segment_urls = sample_segment_urls(segment_urls, speed_test_limit)
-                tasks = [get_speed_with_download(ts_url, headers, session, timeout) for ts_url in sampled_segment_urls]
+                byte_budget = get_segment_budget(variant_resolution or resolution)
+                tasks = [get_speed_with_download(ts_url, headers, session, timeout, byte_budget) for ts_url in
+                         sampled_segment_urls]
                 results = await asyncio.gather(*tasks, return_exceptions=True)
                 total_size = sum(result['size'] for result in results if isinstance(result, dict))
                 total_time = sum(result['time'] for result in results if isinstance(result, dict))
@@ -230,6 +322,8 @@ async def get_result(url: str, headers: dict = None, resolution: str = None,
                             try:
                                 parsed = get_video_info(ff_out)
                                 if parsed:
+                                    stream_probed = any(
+                                        parsed.get(key) for key in ('resolution', 'video_codec', 'audio_codec'))
                                     parsed_speed = parsed.get('speed')
                                     parsed_resolution = parsed.get('resolution')
                                     parsed_fps = parsed.get('fps')
@@ -253,7 +347,8 @@ async def get_result(url: str, headers: dict = None, resolution: str = None,
     except:
         pass
     finally:
-        if filter_resolution and not location and not info.get('resolution') and info.get('delay') != -1:
+        if (filter_resolution and not location and not stream_probed and not info.get('resolution')
+                and info.get('delay') != -1):
             try:
                 probed = await probe_url(url, headers, timeout=timeout)
                 if probed:
@@ -266,13 +361,12 @@ async def get_result(url: str, headers: dict = None, resolution: str = None,
         return info
 
 
-async def get_delay_requests(url, timeout=speed_test_timeout, proxy=None):
+async def get_delay_requests(url, timeout=speed_test_timeout, proxy=None, session: ClientSession = None):
     """
     Get the delay of the url by requests
     """
-    async with ClientSession(
-            connector=TCPConnector(ssl=False), trust_env=True
-    ) as session:
+    async with (nullcontext(session) if session else
+                ClientSession(connector=TCPConnector(ssl=False), trust_env=True)) as session:
         start = time()
         end = None
         try:
@@ -400,37 +494,113 @@ def get_video_info(video_info):
     }
 
 
-def sample_segment_urls(segment_urls: list, limit: int) -> list:
+def get_sample_indices(total: int, limit: int) -> list[int]:
     """
-    Sample up to `limit` segment URLs from `segment_urls` evenly across the playlist.
-    If `limit` >= len(segment_urls) the original list is returned.
+    Get up to `limit` indices spread evenly across `total` items, in ascending order.
+    If `limit` >= `total` all the indices are returned.
     """
-    if not segment_urls:
+    if total <= 0:
         return []
     try:
         limit = int(limit) if limit is not None else 0
     except Exception:
         limit = 0
-    total = len(segment_urls)
     if limit <= 0 or limit >= total:
-        return list(segment_urls)
+        return list(range(total))
     if limit == 1:
-        return [segment_urls[total // 2]]
+        return [total // 2]
+    seen = set()
     indices = []
     for i in range(limit):
-        idx = round(i * (total - 1) / (limit - 1))
-        indices.append(idx)
-    seen = set()
-    sampled = []
-    for idx in indices:
-        if idx < 0:
-            idx = 0
-        if idx >= total:
-            idx = total - 1
+        idx = min(max(round(i * (total - 1) / (limit - 1)), 0), total - 1)
         if idx not in seen:
             seen.add(idx)
-            sampled.append(segment_urls[idx])
-    return sampled
+            indices.append(idx)
+    return indices
+
+
+def sample_segment_urls(segment_urls: list, limit: int) -> list:
+    """
+    Sample up to `limit` segment URLs from `segment_urls` evenly across the playlist.
+    If `limit` >= len(segment_urls) the original list is returned.
+    """
+    if not segment_urls:
+        return []
+    return [segment_urls[idx] for idx in get_sample_indices(len(segment_urls), limit)]
+
+
+def parse_hls_playlist(content: str, segment_limit: int = 0) -> dict | None:
+    """
+    Parse the variants (bandwidth, resolution, uri) and the segments (uri, duration) of a HLS playlist line by line.
+    With `segment_limit`, only the segments picked by `sample_segment_urls` are kept and the parsing stops after
+    the last of them.
+    Return None for the playlists that need the full m3u8 parser.
+    """
+    if not content.lstrip().startswith('#EXTM3U') or '#EXT-X-BYTERANGE' in content:
+        return None
+    wanted = set(get_sample_indices(content.count('#EXTINF:'), segment_limit))
+    last_wanted = max(wanted, default=-1)
+    variants = []
+    segments = []
+    variant_attrs = None
+    duration = None
+    index = 0
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '#':
+            if line.startswith('#EXTINF:'):
+                try:
+                    duration = float(line[8:].split(',', 1)[0])
+                except ValueError:
+                    return None
+            elif line.startswith('#EXT-X-STREAM-INF:'):
+                variant_attrs = line[18:]
+            continue
+        if variant_attrs is not None:
+            bandwidth = hls_bandwidth_pattern.search(variant_attrs)
+            resolution = hls_resolution_pattern.search(variant_attrs)
+            variants.append({
+                'bandwidth': int(bandwidth.group(1)) if bandwidth else 0,
+                'resolution': resolution.group(1) if resolution else None,
+                'uri': line,
+            })
+            variant_attrs = None
+        elif duration is not None:
+            if index in wanted:
+                segments.append({'uri': line, 'duration': duration})
+            index += 1
+            duration = None
+            if index > last_wanted and not variants:
+                break
+        else:
+            return None
+    if not variants and not segments:
+        return None
+    return {'variants': variants, 'segments': segments}
+
+
+def parse_playlist(content: str, segment_limit: int = 0) -> dict:
+    """
+    Parse the HLS playlist with the line parser, falling back to the m3u8 library
+    """
+    playlist = parse_hls_playlist(content, segment_limit)
+    if playlist is not None:
+        return playlist
+    m3u8_obj = m3u8.loads(content)
+    return {
+        'variants': [
+            {
+                'bandwidth': variant.stream_info.bandwidth or 0,
+                'resolution': "x".join(map(str, variant.stream_info.resolution))
+                if variant.stream_info.resolution else None,
+                'uri': variant.uri,
+            }
+            for variant in m3u8_obj.playlists
+        ],
+        'segments': [{'uri': segment.uri, 'duration': segment.duration} for segment in m3u8_obj.segments],
+    }
 
 
 def get_avg_result(result) -> TestResult:
@@ -452,8 +622,49 @@ def get_speed_result(key: str) -> TestResult:
         return {'speed': 0, 'delay': -1, 'resolution': None}
 
 
+class SingleFlight:
+    """
+    Share one in-flight call between the concurrent callers of the same key
+    """
+
+    def __init__(self):
+        self._calls: dict[str, list] = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, func):
+        """
+        Run func for the key, or wait for the call already in flight for it.
+        The shared call is only cancelled once all of its callers were cancelled, and the last caller
+        waits until it actually stopped: every running call is covered by the concurrency slots of at
+        least one of its callers, which keeps the host and global limits exact.
+        """
+        call = self._calls.get(key)
+        if call:
+            call[1] += 1
+        else:
+            call = [asyncio.ensure_future(func()), 1]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] <= 0 and not call[0].done():
+                call[0].cancel()
+                while not call[0].done():
+                    try:
+                        await asyncio.wait([call[0]])
+                    except asyncio.CancelledError:
+                        pass
+
+
+single_flight = SingleFlight()
+
+
 async def get_speed(data, headers=None, ipv6_proxy=None, filter_resolution=open_filter_resolution,
-                    timeout=speed_test_timeout, logger=None, callback=None) -> TestResult:
+                    timeout=speed_test_timeout, logger=None, callback=None, session: ClientSession = None) -> TestResult:
     """
     Get the speed (response time and resolution) of the url
     """
@@ -461,34 +672,55 @@ async def get_speed(data, headers=None, ipv6_proxy=None, filter_resolution=open_
     resolution = data['resolution']
     result: TestResult = {'speed': 0, 'delay': -1, 'resolution': resolution}
     headers = {**request_headers, **(headers or {})}
+
+    async def probe() -> TestResult:
+        probe_result: TestResult = {'speed': 0, 'delay': -1, 'resolution': resolution}
+        if data['ipv_type'] == "ipv6" and ipv6_proxy:
+            probe_result.update(default_ipv6_result)
+        elif constants.rt_url_pattern.match(url) is not None:
+            rt_headers = await get_headers(url, headers, session)
+            if rt_headers:
+                ff_out, elapsed = await ffmpeg_url(url, headers, timeout, return_elapsed=True)
+                if ff_out:
+                    try:
+                        parsed = get_video_info(ff_out)
+                        if parsed:
+                            probe_result['delay'] = int(round(elapsed * 1000))
+                            probe_result['speed'] = parsed['speed']
+                            probe_result['resolution'] = parsed['resolution']
+                            probe_result['fps'] = parsed['fps']
+                            probe_result['video_codec'] = parsed['video_codec']
+                            probe_result['audio_codec'] = parsed['audio_codec']
+                    except Exception:
+                        pass
+        else:
+            probe_result.update(await get_result(url, headers, resolution, filter_resolution, timeout, session))
+        if cache_key:
+            cache.setdefault(cache_key, []).append(probe_result)
+            if store_samples and not math.isinf(probe_result.get('speed') or 0):
+                speed_store.add_result(cache_key, url, data.get('host'), probe_result)
+        return probe_result
+
     try:
         cache_key = data['host'] if speed_test_filter_host else url
         if cache_key and cache_key in cache:
             result = get_avg_result(cache[cache_key])
+            if all(item.get('stored') for item in cache[cache_key]):
+                result['stored'] = True
+        elif stored_result := speed_store.get_fresh_result(cache_key, speed_test_cache_ttl):
+            result.update({key: value for key, value in stored_result.items() if value is not None})
+            result['stored'] = True
+            stats["store_hits"] += 1
+            cache.setdefault(cache_key, []).append(result)
+        elif is_download_budget_exhausted():
+            result.update({'speed': None, 'delay': None, 'skipped': True})
+            stats["budget_skipped"] += 1
+        elif cache_key:
+            if cache_key in single_flight:
+                stats["coalesced"] += 1
+            result.update(await single_flight.do(cache_key, probe))
         else:
-            if data['ipv_type'] == "ipv6" and ipv6_proxy:
-                result.update(default_ipv6_result)
-            elif constants.rt_url_pattern.match(url) is not None:
-                rt_headers = await get_headers(url, headers)
-                if rt_headers:
-                    start_time = time()
-                    ff_out = await ffmpeg_url(url, headers, timeout)
-                    if ff_out:
-                        try:
-                            parsed = get_video_info(ff_out)
-                            if parsed:
-                                result['delay'] = int(round((time() - start_time) * 1000))
-                                result['speed'] = parsed['speed']
-                                result['resolution'] = parsed['resolution']
-                                result['fps'] = parsed['fps']
-                                result['video_codec'] = parsed['video_codec']
-                                result['audio_codec'] = parsed['audio_codec']
-                        except Exception:
-                            pass
-            else:
-                result.update(await get_result(url, headers, resolution, filter_resolution, timeout))
-            if cache_key:
-                cache.setdefault(cache_key, []).append(result)
+            result.update(await probe())
     finally:
         if callback:
             callback()
@@ -523,7 +755,7 @@ def get_sort_result(
             result.get("delay"),
             result.get("resolution")
         )
-        if result_delay == -1:
+        if result_delay == -1 or result.get("skipped"):
             continue
         if not supply:
             if filter_speed and result_speed < resolution_speed_map.get(resolution, min_speed):
@@ -539,7 +771,9 @@ def get_sort_result(
 
 def clear_cache():
     """
-    Clear the speed test cache
+    Clear the speed test cache and the run statistics
     """
     global cache
     cache = {}
+    stats.clear()
+    reset_subprocess_stats()
@@ -0,0 +1,191 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import zlib
+from collections import defaultdict
+from logging import INFO
+
+import utils.constants as constants
+import utils.frozen as frozen
+import utils.speed as speed
+import utils.speed_store as speed_store
+from utils.channel import test_speed, get_speed_test_host, generate_speed_test_statistic
+from utils.config import config
+from utils.ffmpeg import subprocess_stats
+from utils.tools import get_logger, close_logger_handlers
+
+result_poll_interval = 1
+
+
+def split_data_by_host(data, process_num):
+    """
+    Split the channel data into shards by the hash of the host, so every host is tested by one shard only
+    """
+    shards = [defaultdict(lambda: defaultdict(list)) for _ in range(process_num)]
+    for cate, channel_obj in data.items():
+        for name, info_list in channel_obj.items():
+            for info in info_list:
+                host = get_speed_test_host(info) or ""
+                shards[zlib.crc32(host.encode("utf-8")) % process_num][cate][name].append(info)
+    return [{cate: dict(channel_obj) for cate, channel_obj in shard.items()} for shard in shards if shard]
+
+
+def _get_cache_key(info):
+    return info.get("host") if config.speed_test_filter_host else info.get("url")
+
+
+def _listen_control(control_queue, loop, cancel_channel):
+    while True:
+        message = control_queue.get()
+        if message is None:
+            break
+        try:
+            loop.call_soon_threadsafe(cancel_channel, *message)
+        except RuntimeError:
+            break
+
+
+async def _run_shard(index, data, ipv6, result_queue, control_queue):
+    loop = asyncio.get_running_loop()
+
+    def on_start(cancel_channel):
+        threading.Thread(target=_listen_control, args=(control_queue, loop, cancel_channel), daemon=True).start()
+
+    def on_task_complete(cate, name, item, is_channel_last, is_last, is_valid):
+        key = _get_cache_key(item)
+        cache_result = speed.get_speed_result(key) if key and key in speed.cache else None
+        result_queue.put(("item", cate, name, item, is_valid, key, cache_result))
+
+    speed.clear_cache()
+    await test_speed(data, ipv6=ipv6, on_task_complete=on_task_complete, on_start=on_start, shard=True)
+    urls = [info.get("url") for channel_obj in data.values() for info_list in channel_obj.values() for info in
+            info_list]
+    result_queue.put(("done", index, frozen.get_entries(urls), dict(speed.stats), dict(subprocess_stats),
+                      speed_store.take_pending()))
+
+
+def run_shard(index, process_num, data, ipv6, frozen_entries, result_queue, control_queue):
+    """
+    Entry of a shard process: test the speed of its part of the data on its own event loop,
+    with an equal share of the download rate limit and budget
+    """
+    speed.set_download_limits(
+        config.speed_test_max_bandwidth / process_num,
+        config.speed_test_max_bytes / process_num,
+    )
+    frozen.update_entries(frozen_entries)
+    speed_store.load(constants.speed_store_path, config.speed_test_cache_ttl * 3600,
+                     prior=config.open_speed_test_priority)
+    asyncio.run(_run_shard(index, data, ipv6, result_queue, control_queue))
+
+
+async def test_speed_sharded(data, process_num, ipv6=False, callback=None, on_task_complete=None):
+    """
+    Test speed of channel data across several processes, the results are streamed back to this process,
+    where the progress, the per channel early exit, the frozen state and the speed cache are kept,
+    and where the samples of the speed store are saved once for all the shards
+    """
+    shards = split_data_by_host(data, process_num)
+    for log_path in (constants.speed_test_log_path, constants.result_log_path):
+        close_logger_handlers(get_logger(log_path, level=INFO, init=True))
+
+    total_tasks = sum(len(info_list) for channel_obj in data.values() for info_list in channel_obj.values())
+    total_tasks_by_channel = defaultdict(int)
+    for cate, channel_obj in data.items():
+        for name, info_list in channel_obj.items():
+            total_tasks_by_channel[(cate, name)] += len(info_list)
+    completed = 0
+    completed_by_channel = defaultdict(int)
+    valid_count_by_channel = defaultdict(int)
+    cancelled_channels = set()
+    grouped_results = defaultdict(lambda: defaultdict(list))
+    urls_limit = config.urls_limit
+    open_full_speed_test = config.open_full_speed_test
+
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    control_queues = [context.Queue() for _ in shards]
+    processes = []
+    for index, shard_data in enumerate(shards):
+        urls = [info.get("url") for channel_obj in shard_data.values() for info_list in channel_obj.values() for info
+                in info_list]
+        process = context.Process(
+            target=run_shard,
+            args=(index, len(shards), shard_data, ipv6, frozen.get_entries(urls), result_queue,
+                  control_queues[index]),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+
+    def _get_message():
+        try:
+            return result_queue.get(timeout=result_poll_interval)
+        except queue.Empty:
+            return None
+
+    loop = asyncio.get_running_loop()
+    running = set(range(len(processes)))
+    try:
+        while running:
+            message = await loop.run_in_executor(None, _get_message)
+            if message is None:
+                running = {index for index in running if processes[index].is_alive()}
+                continue
+            if message[0] == "done":
+                _, index, frozen_entries, run_stats, run_subprocess_stats, samples = message
+                frozen.update_entries(frozen_entries)
+                speed_store.add_pending(samples)
+                speed.stats.update(run_stats)
+                subprocess_stats.update(run_subprocess_stats)
+                running.discard(index)
+                continue
+
+            _, cate, name, item, is_valid, key, cache_result = message
+            if key and cache_result and key not in speed.cache:
+                speed.cache[key] = [cache_result]
+            grouped_results[cate][name].append(item)
+            completed += 1
+            completed_by_channel[(cate, name)] += 1
+            is_channel_last = completed_by_channel[(cate, name)] >= total_tasks_by_channel.get((cate, name), 0)
+            is_last = completed >= total_tasks
+
+            if is_valid:
+                valid_count_by_channel[(cate, name)] += 1
+                if (not open_full_speed_test and valid_count_by_channel[(cate, name)] >= urls_limit
+                        and (cate, name) not in cancelled_channels):
+                    cancelled_channels.add((cate, name))
+                    for control_queue in control_queues:
+                        control_queue.put((cate, name))
+
+            if on_task_complete:
+                try:
+                    on_task_complete(cate, name, item, is_channel_last, is_last, is_valid)
+                except Exception:
+                    pass
+
+            if callback:
+                try:
+                    callback()
+                except Exception:
+                    pass
+    finally:
+        for control_queue in control_queues:
+            control_queue.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    try:
+        generate_speed_test_statistic(
+            get_logger(constants.statistic_log_path, level=INFO),
+            {**speed.stats, **subprocess_stats}
+        )
+    except Exception:
+        pass
+    return {cate: dict(channel_obj) for cate, channel_obj in grouped_results.items()}
+
+
+__all__ = ["split_data_by_host", "run_shard", "test_speed_sharded"]
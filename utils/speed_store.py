@@ -0,0 +1,125 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from utils.db import get_db_connection, return_db_connection
+from utils.i18n import t
+from utils.types import TestResult
+
+SAMPLE_RETENTION = 7 * 24 * 3600
+
+_RESULT_FIELDS = ("speed", "delay", "resolution", "fps", "video_codec", "audio_codec")
+
+_latest: Dict[str, Tuple[int, TestResult]] = {}
+_pending: List[tuple] = []
+
+
+def _now_ts() -> int:
+    return int(time.time())
+
+
+def _ensure_schema(conn) -> None:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS speed_result (key TEXT NOT NULL, url TEXT, host TEXT, speed REAL, delay INTEGER, resolution TEXT, fps REAL, video_codec TEXT, audio_codec TEXT, timestamp INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS speed_result_key_timestamp ON speed_result (key, timestamp)")
+
+
+def get_fresh_result(key: str, ttl: float) -> Optional[TestResult]:
+    """
+    Get the latest stored result of the key if it is younger than ttl seconds
+    """
+    if not key or ttl <= 0:
+        return None
+    entry = _latest.get(key)
+    if not entry:
+        return None
+    timestamp, result = entry
+    if _now_ts() - timestamp > ttl:
+        return None
+    return dict(result)
+
+
+def add_result(key: str, url: str, host: str, result: TestResult) -> None:
+    """
+    Record a new timestamped sample of the key, persisted on the next save
+    """
+    if not key:
+        return
+    timestamp = _now_ts()
+    sample = {field: result.get(field) for field in _RESULT_FIELDS}
+    _latest[key] = (timestamp, sample)
+    _pending.append((key, url, host, *(sample[field] for field in _RESULT_FIELDS), timestamp))
+
+
+def take_pending() -> List[tuple]:
+    """
+    Take the samples not saved yet, to hand them to the process that saves the store
+    """
+    samples = list(_pending)
+    _pending.clear()
+    return samples
+
+
+def add_pending(samples: List[tuple]) -> None:
+    """
+    Add the samples taken from another process, persisted on the next save
+    """
+    _pending.extend(samples)
+
+
+def load(path: Optional[str], ttl: float, prior: bool = False) -> None:
+    """
+    Load the latest sample of every key measured within ttl seconds, or within the retention window
+    with prior, for the prioritised dispatch; the reuse of a sample still checks its age against the ttl
+    """
+    _latest.clear()
+    _pending.clear()
+    window = max(ttl, SAMPLE_RETENTION) if prior else ttl
+    if not path or window <= 0 or not os.path.exists(path):
+        return
+    conn = None
+    try:
+        conn = get_db_connection(path)
+        _ensure_schema(conn)
+        rows = conn.execute(
+            f"SELECT key, {', '.join(_RESULT_FIELDS)}, MAX(timestamp) FROM speed_result WHERE timestamp >= ? GROUP BY key",
+            (_now_ts() - int(window),)
+        ).fetchall()
+        for row in rows:
+            _latest[row[0]] = (row[-1], dict(zip(_RESULT_FIELDS, row[1:-1])))
+    except Exception:
+        pass
+    finally:
+        if conn:
+            return_db_connection(path, conn)
+
+
+def save(path: Optional[str]) -> None:
+    """
+    Append the pending samples and drop the ones older than the retention window
+    """
+    if not path or not _pending:
+        return
+    conn = None
+    try:
+        dirp = os.path.dirname(path)
+        if dirp:
+            os.makedirs(dirp, exist_ok=True)
+        conn = get_db_connection(path)
+        _ensure_schema(conn)
+        with conn:
+            conn.executemany(
+                f"INSERT INTO speed_result (key, url, host, {', '.join(_RESULT_FIELDS)}, timestamp) VALUES ({', '.join('?' * (len(_RESULT_FIELDS) + 4))})",
+                _pending
+            )
+            conn.execute("DELETE FROM speed_result WHERE timestamp < ?", (_now_ts() - SAMPLE_RETENTION,))
+        _pending.clear()
+    except Exception as e:
+        print(t("msg.error_save_cache").format(info=e))
+    finally:
+        if conn:
+            return_db_connection(path, conn)
+
+
+__all__ = ["get_fresh_result", "add_result", "take_pending", "add_pending", "load", "save"]
@@ -191,83 +191,72 @@ def get_resolution_value(resolution_str):
     return 0
 
 
-def get_total_urls(
+def get_total_urls_by_prefer(
         info_list: list[ChannelData],
-        ipv_type_prefer,
+        ipv_type_prefers,
         origin_type_prefer,
         rtmp_type=None,
         apply_limit: bool = True,
-) -> list:
+) -> dict[tuple, list]:
     """
-    Get the total urls from info list
+    Get the total urls from info list for several ipv type prefers at once, the info list is classified
+    a single time and the result of every prefer is keyed by its tuple
     """
-    ipv_prefer_bool = bool(ipv_type_prefer)
     origin_prefer_bool = bool(origin_type_prefer)
-    if not ipv_prefer_bool:
-        ipv_type_prefer = ["all"]
     if not origin_prefer_bool:
         origin_type_prefer = ["all"]
-    categorized_urls = {origin: {ipv_type: [] for ipv_type in ipv_type_prefer} for origin in origin_type_prefer}
-    total_urls = []
+    retained_urls = []
+    urls_by_origin = {origin: [] for origin in origin_type_prefer}
+    categorized_urls = {origin: defaultdict(list) for origin in origin_type_prefer}
     for info in info_list:
-        channel_id, url, origin, resolution, url_ipv_type, extra_info = (
-            info["id"],
-            info["url"],
-            info["origin"],
-            info["resolution"],
-            info["ipv_type"],
-            info.get("extra_info", ""),
-        )
+        origin = info["origin"]
         if not origin:
             continue
 
         if origin == "hls":
-            if not rtmp_type or (rtmp_type and origin in rtmp_type):
-                total_urls.append(info)
-                continue
-            else:
-                continue
+            if not rtmp_type or origin in rtmp_type:
+                retained_urls.append(info)
+            continue
 
         if origin == "whitelist":
-            total_urls.append(info)
+            retained_urls.append(info)
             continue
 
         if origin_prefer_bool and (origin not in origin_type_prefer):
             continue
 
-        if not extra_info:
+        if not info.get("extra_info", ""):
             info["extra_info"] = constants.origin_map[origin]
 
         if not origin_prefer_bool:
             origin = "all"
 
-        if ipv_prefer_bool:
-            if url_ipv_type in ipv_type_prefer:
-                categorized_urls[origin][url_ipv_type].append(info)
-        else:
-            categorized_urls[origin]["all"].append(info)
+        urls_by_origin[origin].append(info)
+        categorized_urls[origin][info["ipv_type"]].append(info)
 
     urls_limit = config.urls_limit if apply_limit else None
-    for origin in origin_type_prefer:
-        if urls_limit is not None and len(total_urls) >= urls_limit:
-            break
-        for ipv_type in ipv_type_prefer:
+    result = {}
+    for ipv_type_prefer in ipv_type_prefers:
+        ipv_key = tuple(ipv_type_prefer or ())
+        if ipv_key in result:
+            continue
+        total_urls = list(retained_urls)
+        for origin in origin_type_prefer:
             if urls_limit is not None and len(total_urls) >= urls_limit:
                 break
-            urls = categorized_urls[origin].get(ipv_type, [])
-            if not urls:
-                continue
-            if urls_limit is None:
-                total_urls.extend(urls)
-            else:
-                remaining = urls_limit - len(total_urls)
-                limit_urls = urls[:remaining]
-                total_urls.extend(limit_urls)
-
-    if urls_limit is not None:
-        total_urls = total_urls[:urls_limit]
-
-    return total_urls
+            groups = [categorized_urls[origin].get(ipv_type, []) for ipv_type in ipv_key] if ipv_key else [
+                urls_by_origin[origin]]
+            for urls in groups:
+                if urls_limit is not None and len(total_urls) >= urls_limit:
+                    break
+                if not urls:
+                    continue
+                if urls_limit is None:
+                    total_urls.extend(urls)
+                else:
+                    total_urls.extend(urls[:urls_limit - len(total_urls)])
+        result[ipv_key] = total_urls[:urls_limit] if urls_limit is not None else total_urls
+    return result
 
 
 def get_total_urls_from_sorted_data(data):
@@ -438,65 +427,70 @@ def get_channel_epg_id(name: str | None) -> str:
     return _channel_alias_instance.get_primary(name)
 
 
-def convert_to_m3u(path=None, first_channel_name=None, data=None):
+def get_m3u_header() -> str:
     """
-    Convert result txt to m3u format
+    Get the header line of the m3u result
     """
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as file:
-            m3u_output = f'#EXTM3U x-tvg-url="{get_epg_url()}"\n' if config.open_epg else "#EXTM3U\n"
-            current_group = None
-            logo_url = get_logo_url()
-            from_fanmingming = "https://raw.githubusercontent.com/fanmingming/live/main/tv" in logo_url
-            for line in file:
-                trimmed_line = line.strip()
-                if trimmed_line != "":
-                    if "#genre#" in trimmed_line:
-                        current_group = trimmed_line.replace(",#genre#", "").strip()
-                    else:
-                        try:
-                            original_channel_name, _, channel_link = map(
-                                str.strip, trimmed_line.partition(",")
-                            )
-                        except:
-                            continue
-                        use_name = first_channel_name if current_group in (t("content.update_time"),
-                                                                           t("content.update_running")) else original_channel_name
-                        processed_channel_name = use_name
-                        if from_fanmingming:
-                            processed_channel_name = re.sub(
-                                r"(CCTV|CETV)-(\d+)(\+.*)?",
-                                lambda m: f"{m.group(1)}{m.group(2)}"
-                                          + ("+" if m.group(3) else ""),
-                                use_name,
-                            )
-                        tvg_id = get_channel_epg_id(use_name) or processed_channel_name
-
-                        m3u_output += f'#EXTINF:-1 tvg-id="{tvg_id}" tvg-name="{processed_channel_name}" tvg-logo="{join_url(logo_url, f"{processed_channel_name}.{config.logo_type}")}"'
-                        if current_group:
-                            m3u_output += f' group-title="{current_group}"'
-                        item_data = {}
-                        if data:
-                            item_list = data.get(original_channel_name, [])
-                            for item in item_list:
-                                if item["url"] == channel_link:
-                                    item_data = item
-                                    break
-                        if item_data:
-                            catchup = item_data.get("catchup")
-                            if catchup:
-                                for key, value in catchup.items():
-                                    m3u_output += f' {key}="{value}"'
-                        m3u_output += f",{original_channel_name}\n"
-                        if item_data and config.open_headers:
-                            headers = item_data.get("headers")
-                            if headers:
-                                for key, value in headers.items():
-                                    m3u_output += f"#EXTVLCOPT:http-{key.lower()}={value}\n"
-                        m3u_output += f"{channel_link}\n"
-            m3u_file_path = os.path.splitext(path)[0] + ".m3u"
-            with open(m3u_file_path, "w", encoding="utf-8") as m3u_file:
-                m3u_file.write(m3u_output)
+    return f'#EXTM3U x-tvg-url="{get_epg_url()}"\n' if config.open_epg else "#EXTM3U\n"
+
+
+class M3UEmitter:
+    """
+    Emitter of m3u entries from the structured channel data, the tvg attributes of a channel name
+    (the EPG id, the logo and the rewritten name) are built once and reused for all its entries
+    """
+
+    fanmingming_pattern = re.compile(r"(CCTV|CETV)-(\d+)(\+.*)?")
+
+    def __init__(self):
+        self.logo_url = get_logo_url()
+        self.from_fanmingming = "https://raw.githubusercontent.com/fanmingming/live/main/tv" in self.logo_url
+        self.logo_type = config.logo_type
+        self.open_headers = config.open_headers
+        self.header = get_m3u_header()
+        self._tvg_attrs: dict[str, str] = {}
+
+    def get_tvg_attrs(self, name: str) -> str:
+        """
+        Get the tvg attributes of the channel name
+        """
+        attrs = self._tvg_attrs.get(name)
+        if attrs is None:
+            processed_channel_name = name
+            if self.from_fanmingming:
+                processed_channel_name = self.fanmingming_pattern.sub(
+                    lambda m: f"{m.group(1)}{m.group(2)}" + ("+" if m.group(3) else ""),
+                    name,
+                )
+            tvg_id = get_channel_epg_id(name) or processed_channel_name
+            logo = join_url(self.logo_url, f"{processed_channel_name}.{self.logo_type}")
+            attrs = f'tvg-id="{tvg_id}" tvg-name="{processed_channel_name}" tvg-logo="{logo}"'
+            self._tvg_attrs[name] = attrs
+        return attrs
+
+    def entry(self, name, url, group=None, item=None, tvg_name=None) -> str:
+        """
+        Get the m3u entry of a channel url
+        :param name: the channel name shown by the entry
+        :param url: the channel url
+        :param group: the group title
+        :param item: the channel data of the url, for the catchup attributes and headers
+        :param tvg_name: the name used for the tvg attributes, the channel name by default
+        """
+        parts = ["#EXTINF:-1 ", self.get_tvg_attrs(tvg_name if tvg_name is not None else name)]
+        if group:
+            parts.append(f' group-title="{group}"')
+        if item:
+            catchup = item.get("catchup")
+            if catchup:
+                parts.extend(f' {key}="{value}"' for key, value in catchup.items())
+        parts.append(f",{name}\n")
+        if item and self.open_headers:
+            headers = item.get("headers")
+            if headers:
+                parts.extend(f"#EXTVLCOPT:http-{key.lower()}={value}\n" for key, value in headers.items())
+        parts.append(f"{url}\n")
+        return "".join(parts)
 
 
 def get_result_file_content(path=None, show_content=False, file_type=None):
@@ -1071,24 +1065,6 @@ def build_path_list(
     return sorted(paths)
 
 
-def to_serializable(obj):
-    """
-    Convert an object to a serializable form.
-    Handles dicts, lists, tuples, sets, and other iterables recursively.
-    Non-serializable objects are returned as-is.
-    """
-    if isinstance(obj, dict):
-        return {k: to_serializable(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple, set)):
-        return [to_serializable(i) for i in obj]
-    try:
-        if not isinstance(obj, (str, bytes)) and hasattr(obj, "__iter__"):
-            return [to_serializable(i) for i in obj]
-    except Exception:
-        pass
-    return obj
-
-
 def count_files_by_ext(
         dir_path: Union[str, Path],
         exts: Optional[Union[str, Iterable[str]]] = None,
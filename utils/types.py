@@ -38,6 +38,8 @@ class TestResult(TypedDict):
     video_codec: NotRequired[str | None]
     audio_codec: NotRequired[str | None]
     fps: NotRequired[float | None]
+    skipped: NotRequired[bool]
+    stored: NotRequired[bool]
 
 
 TestResultCacheData = dict[str, list[TestResult]]